@@ -0,0 +1,294 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from itertools import combinations
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+import pandas as pd
+
+from sklearn.decomposition import (
+    PCA,
+    IncrementalPCA,
+    KernelPCA,
+    SparsePCA,
+    TruncatedSVD,
+)
+from sklearn.manifold import TSNE, Isomap, LocallyLinearEmbedding, SpectralEmbedding
+
+import loader
+
+from correlations import get_significant_correlations, plot_all_pairs
+from loader import cols_qualitative, cols_quantitative, features, normalize_df
+from regression import (
+    get_col_subset_score_table,
+    get_gram_system,
+    get_terms,
+    score_col_subset,
+)
+
+# Methods benchmarked by the dim_reduce stage, with the largest registry (in rows) each is
+# run on; the kernel, neighbor-graph and TSNE methods need memory or time quadratic in the
+# number of discs.
+methods = {
+    "PCA": (lambda: PCA(n_components=2), None),
+    "IncrementalPCA": (lambda: IncrementalPCA(n_components=2), None),
+    "SparsePCA": (lambda: SparsePCA(n_components=2), None),
+    "TruncatedSVD": (lambda: TruncatedSVD(n_components=2), None),
+    "KernelPCA": (lambda: KernelPCA(n_components=2), 2000),
+    "Isomap": (lambda: Isomap(n_components=2, n_neighbors=10), 2000),
+    "LLE": (lambda: LocallyLinearEmbedding(n_components=2, n_neighbors=12), 2000),
+    "Spectral NN": (lambda: SpectralEmbedding(affinity="nearest_neighbors"), 2000),
+    "Spectral RBF": (lambda: SpectralEmbedding(affinity="rbf"), 2000),
+    "TSNE": (lambda: TSNE(), 2000),
+}
+
+# Seconds a fresh interpreter may spend importing each module, net of its own startup.
+# `cli` bounds `python cli.py --help`; the analysis modules defer matplotlib and sklearn,
+# except for dim_reduce, which is built around sklearn.manifold.
+startup_budgets = {
+    "cli": 0.05,
+    "loader": 0.75,
+    "regression": 1.0,
+    "correlations": 1.0,
+    "predict": 1.0,
+    "update": 1.0,
+    "dim_reduce": 3.0,
+}
+
+
+def make_registry(directory, scale, seed=0):
+    """Write a synthetic registry `scale` times the size of pdga.csv, together with
+    innova.csv, to `directory`.
+
+    Discs are resampled from the registry with a small jitter on their measurements, so
+    that the distributions, the null entries and the Innova join all scale with it.
+    """
+    source = pd.read_csv("pdga.csv", header=0, dtype=str, keep_default_na=False)
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(len(source), size=int(len(source) * scale))
+    registry = source.iloc[rows].reset_index(drop=True)
+    if scale != 1:
+        for idx, col in enumerate(cols_quantitative, start=len(cols_qualitative)):
+            values = pd.to_numeric(registry.iloc[:, idx], errors="coerce")
+            jitter = rng.normal(scale=0.01, size=len(values)) * values.std()
+            registry.iloc[:, idx] = (values + jitter).round(2).astype(str)
+            registry.iloc[values.isna().to_numpy(), idx] = ""
+    registry.to_csv(os.path.join(directory, "pdga.csv"), index=False, quoting=1)
+    shutil.copy("innova.csv", directory)
+    os.makedirs(os.path.join(directory, "Figures", "Correlations"))
+
+
+@contextmanager
+def measure(results, stage):
+    """Record the wall time and peak traced memory of the enclosed block under `stage`."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[stage] = {"seconds": elapsed, "peak_bytes": peak}
+
+
+def run_stages(scale, seed=0):
+    """Run each pipeline stage once on a synthetic registry of the given `scale` and return
+    the wall time and peak memory of each."""
+    results = dict()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        make_registry(directory, scale, seed=seed)
+        os.chdir(directory)
+        try:
+            # The first load also writes the snapshot, so the parse is timed on its own.
+            with measure(results, "load_csv"):
+                df = loader._read_pdga_csv("pdga.csv")
+            loader.write_snapshot("pdga.csv", df)
+
+            loader.invalidate_cache()
+            with measure(results, "load_snapshot"):
+                loader.get_df_pdga()
+
+            with measure(results, "innova_join"):
+                df_innova = loader.get_df_innova(include_stability=True)
+
+            with measure(results, "subset_search"):
+                get_col_subset_score_table(
+                    df_innova, cols_quantitative, list(features), num_cols=2, degree=2
+                )
+
+            df_all = loader.get_df_pdga_quantitative()
+            with measure(results, "correlations"):
+                get_significant_correlations(df_all, list(cols_quantitative))
+
+            X = normalize_df(df_all)[list(cols_quantitative)]
+            for name, (make_method, max_rows) in methods.items():
+                if max_rows is None or len(X) <= max_rows:
+                    with measure(results, f"dim_reduce:{name}"):
+                        make_method().fit_transform(X)
+
+            with measure(results, "savefig"):
+                plot_all_pairs(density=True)
+        finally:
+            os.chdir(cwd)
+            loader.invalidate_cache()
+    return results
+
+
+def run_benchmarks(scales=(1, 10, 100), repeat=3, seed=0):
+    """Return the best-of-`repeat` results of `run_stages` at each of `scales`."""
+    benchmarks = dict()
+    for scale in scales:
+        best = dict()
+        for _ in range(repeat):
+            for stage, result in run_stages(scale, seed=seed).items():
+                if stage not in best or result["seconds"] < best[stage]["seconds"]:
+                    best[stage] = result
+        benchmarks[str(scale)] = best
+    return benchmarks
+
+
+def compare(benchmarks, baseline, tolerance=1.5):
+    """Return the (scale, stage, slowdown) of each stage that is more than `tolerance` times
+    slower in `benchmarks` than in `baseline`."""
+    regressions = []
+    for scale, stages in benchmarks.items():
+        for stage, result in stages.items():
+            before = baseline.get(scale, dict()).get(stage)
+            if before is not None:
+                slowdown = result["seconds"] / before["seconds"]
+                if slowdown > tolerance:
+                    regressions.append((scale, stage, slowdown))
+    return regressions
+
+
+def _time_import(module):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+    return time.perf_counter() - start
+
+
+def measure_startup(modules=tuple(startup_budgets), repeat=3):
+    """Return the best-of-`repeat` seconds a fresh interpreter takes to import each of
+    `modules`, less the time it takes to start an interpreter at all."""
+    interpreter = min(_time_import("sys") for _ in range(repeat))
+    return {
+        module: min(_time_import(module) for _ in range(repeat)) - interpreter
+        for module in modules
+    }
+
+
+def check_scores(df, cols, targets, degrees=(1, 2, 3, 4), num_cols=3, tolerance=1e-6):
+    """Return the (scoring, degree, col_subset, deviation) of each size-`num_cols` subset
+    of `cols` whose score from `regression.score_col_subset` deviates by more than
+    `tolerance` (relative to scores beyond 1 in size) from refitting its design matrix
+    with np.linalg.lstsq on each training set."""
+    failures = []
+    for scoring in ("r2", "loo", "kfold"):
+        for degree in degrees:
+            system = get_gram_system(df, cols, targets, degree=degree, scoring=scoring)
+            X = system["design"]
+            Y = system["response"]
+            if scoring == "r2":
+                held_out = [np.arange(len(X))]
+            elif scoring == "loo":
+                held_out = [[idx] for idx in range(len(X))]
+            else:
+                held_out = system["folds"]
+
+            for col_subset in combinations(cols, num_cols):
+                X_subset = X[:, get_terms(cols, system["powers"], col_subset)]
+                residuals = np.empty_like(Y)
+                for rows in held_out:
+                    train = np.ones(len(X), dtype=bool)
+                    if scoring != "r2":
+                        train[rows] = False
+                    coefs = np.linalg.lstsq(X_subset[train], Y[train], rcond=None)[0]
+                    residuals[rows] = Y[rows] - X_subset[rows] @ coefs
+                expected = 1 - (residuals**2).sum(axis=0) / system["tss"]
+                # Degenerate subsets can score far below zero, so large scores are
+                # compared relative to their size.
+                deviation = (
+                    np.abs(score_col_subset(system, col_subset) - expected)
+                    / np.maximum(1, np.abs(expected))
+                ).max()
+                if deviation > tolerance:
+                    failures.append((scoring, degree, col_subset, deviation))
+    return failures
+
+
+def print_table(benchmarks):
+    print(f"{'scale':>6} {'stage':<28} {'seconds':>10} {'peak MiB':>10}")
+    for scale, stages in benchmarks.items():
+        for stage, result in stages.items():
+            print(
+                f"{scale:>6} {stage:<28} {result['seconds']:>10.4f} "
+                f"{result['peak_bytes'] / 2**20:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline.")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results from this file")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="only check the import times against their budgets",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only check the subset scores against direct least-squares fits",
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        failures = check_scores(
+            loader.get_df_innova(), list(cols_quantitative), loader.flight_numbers
+        )
+        for scoring, degree, col_subset, deviation in failures:
+            print(f"{scoring} degree {degree} {col_subset}: off by {deviation:.3g}")
+        raise SystemExit(int(bool(failures)))
+
+    if args.startup:
+        over_budget = False
+        for module, seconds in measure_startup(repeat=args.repeat).items():
+            budget = startup_budgets[module]
+            print(f"{module:<28} {seconds:>10.4f} {budget:>10.4f}")
+            over_budget |= seconds > budget
+        raise SystemExit(int(over_budget))
+
+    benchmarks = run_benchmarks(
+        [int(scale) if scale.is_integer() else scale for scale in args.scales],
+        repeat=args.repeat,
+        seed=args.seed,
+    )
+    print_table(benchmarks)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(benchmarks, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(benchmarks, json.load(f), tolerance=args.tolerance)
+        for scale, stage, slowdown in regressions:
+            print(f"Regression at scale {scale}: {stage} is {slowdown:.2f}x slower")
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,127 @@
+import argparse
+
+# The analysis modules import matplotlib and sklearn, which take seconds to load, so each
+# subcommand imports what it needs when it runs and `--help` stays instant.
+
+
+def regress(args):
+    from regression import analyze_all, analyze_bootstrap, analyze_regularization
+
+    for degree in args.degree:
+        if args.penalty is not None:
+            analyze_regularization(degree, penalty=args.penalty)
+            continue
+        if args.bootstrap:
+            analyze_bootstrap(degree, n_replicates=args.bootstrap, seed=args.seed)
+            continue
+        analyze_all(
+            degree,
+            threshold=args.threshold,
+            executor=args.executor,
+            n_workers=args.workers,
+            scoring=args.scoring,
+            render_workers=args.render_workers,
+        )
+
+
+def correlate(args):
+    from correlations import (
+        analyze_correlations,
+        plot_all_pairs,
+        plot_significant_correlations,
+    )
+
+    if args.permutations:
+        analyze_correlations(
+            threshold=args.threshold, n_permutations=args.permutations, seed=args.seed
+        )
+        return
+    if args.all_pairs:
+        plot_all_pairs(density=args.density)
+    plot_significant_correlations(threshold=args.threshold, n_workers=args.workers)
+
+
+def embed(args):
+    from dim_reduce import make_all_plots
+
+    make_all_plots(n_workers=args.workers)
+
+
+def predict(args):
+    from predict import get_predictor, serve_http, serve_stdin
+
+    predictor = get_predictor(degree=args.degree)
+    if args.http is None:
+        serve_stdin(predictor)
+    else:
+        serve_http(predictor, port=args.http)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Analyze the PDGA disc registry.")
+    subparsers = parser.add_subparsers(required=True, metavar="command")
+
+    parser_regress = subparsers.add_parser(
+        "regress", help="regress the flight numbers on the measurements"
+    )
+    parser_regress.add_argument("--degree", type=int, nargs="+", default=[1, 2])
+    parser_regress.add_argument("--threshold", type=float, default=0.9)
+    parser_regress.add_argument(
+        "--scoring", choices=["r2", "loo", "kfold"], default="r2"
+    )
+    parser_regress.add_argument(
+        "--executor", choices=["serial", "threads", "processes"], default="serial"
+    )
+    parser_regress.add_argument("--workers", type=int, help="subset scoring workers")
+    parser_regress.add_argument("--render-workers", type=int)
+    parser_regress.add_argument(
+        "--penalty",
+        choices=["ridge", "lasso", "elasticnet"],
+        help="only report the best cross-validated alpha of this penalty",
+    )
+    parser_regress.add_argument(
+        "--bootstrap",
+        type=int,
+        metavar="REPLICATES",
+        help="only report the scores with bootstrap confidence intervals",
+    )
+    parser_regress.add_argument("--seed", type=int, default=0)
+    parser_regress.set_defaults(func=regress)
+
+    parser_correlate = subparsers.add_parser(
+        "correlate", help="plot the significant correlations between measurements"
+    )
+    parser_correlate.add_argument("--threshold", type=float, default=0.5)
+    parser_correlate.add_argument("--workers", type=int)
+    parser_correlate.add_argument(
+        "--all-pairs", action="store_true", help="also plot every pair of measurements"
+    )
+    parser_correlate.add_argument("--density", action="store_true")
+    parser_correlate.add_argument(
+        "--permutations",
+        type=int,
+        metavar="PERMUTATIONS",
+        help="only report the pairs with their permutation test p-values",
+    )
+    parser_correlate.add_argument("--seed", type=int, default=0)
+    parser_correlate.set_defaults(func=correlate)
+
+    parser_embed = subparsers.add_parser(
+        "embed", help="plot the 2D embeddings of the registry"
+    )
+    parser_embed.add_argument("--workers", type=int)
+    parser_embed.set_defaults(func=embed)
+
+    parser_predict = subparsers.add_parser(
+        "predict", help="serve flight number predictions"
+    )
+    parser_predict.add_argument("--degree", type=int, default=1)
+    parser_predict.add_argument("--http", type=int, metavar="PORT")
+    parser_predict.set_defaults(func=predict)
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    args.func(args)
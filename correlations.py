@@ -1,11 +1,18 @@
-import matplotlib.pyplot as plt
+import numpy as np
 
-from loader import cols_quantitative
-from dim_reduce import get_df_pdga_quantitative
+from loader import cols_quantitative, get_df_pdga_quantitative
 from math import ceil
+from parallel import get_seeded_batches
+from profiling import timed
+from render import get_density, make_job, plot_density, render_jobs
 
 
-def plot_all_pairs():
+def plot_all_pairs(density=False, bins=64):
+    """Plot every pair of features against each other, either as translucent markers or,
+    if `density`, as `bins` x `bins` histograms whose cost doesn't grow with the number of
+    discs."""
+    import matplotlib.pyplot as plt
+
     df = get_df_pdga_quantitative()
     features = list(cols_quantitative)
     num_features = len(features)
@@ -28,28 +35,238 @@ def plot_all_pairs():
         axes[0, idx].xaxis.set_label_position("top")
         axes[0, idx].set_xlabel(title)
 
+    # Panels share their axes by row and column, so each feature gets a single range.
+    bounds = {feature: [df[feature].min(), df[feature].max()] for feature in features}
     for col_idx, col_feature in enumerate(features):
         for row_idx, row_feature in enumerate(features[: col_idx + 1]):
-            axes[row_idx, col_idx].plot(
-                df[col_feature], df[row_feature], marker="o", ls="", alpha=0.05
+            if density:
+                plot_density(
+                    axes[row_idx, col_idx],
+                    get_density(
+                        df[col_feature],
+                        df[row_feature],
+                        bins=bins,
+                        extent=bounds[col_feature] + bounds[row_feature],
+                    ),
+                    cmap="Blues",
+                )
+            else:
+                axes[row_idx, col_idx].plot(
+                    df[col_feature], df[row_feature], marker="o", ls="", alpha=0.05
+                )
+
+    with timed("savefig", path="Figures/Correlations/all.png"):
+        plt.savefig(f"Figures/Correlations/all.png")
+
+
+def _standardize(df, cols, method):
+    """Return `cols` of `df` (ranked if `method` is "spearman") centered and scaled to unit
+    norm, so that the dot products of its columns are their correlations."""
+    if method == "spearman":
+        X = df[cols].rank().to_numpy(dtype="float64")
+    else:
+        X = df[cols].to_numpy(dtype="float64")
+
+    X = X - X.mean(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return X / np.sqrt((X * X).sum(axis=0))
+
+
+def get_correlation_matrix(df, cols, method="pearson"):
+    """Return the matrix of pairwise correlations between `cols` of `df` as a np.ndarray.
+
+    `method` is "pearson", "spearman" (Pearson on ranks) or "kendall". Unlike
+    `pd.DataFrame.corr`, rows with NaNs are not dropped pairwise, so `df` should have none.
+    """
+    if method == "kendall":
+        return df[cols].corr(method="kendall").to_numpy()
+    X = _standardize(df, cols, method)
+    return X.T @ X
+
+
+def _get_permutations(rng, strata, num_permutations):
+    """Return `num_permutations` random permutations of the rows, each as a row of indices,
+    that only exchange rows within the same stratum."""
+    # Sorting the rows by stratum and then by a random key shuffles each stratum in place.
+    order = np.argsort(strata, kind="stable")
+    keys = strata[order] + rng.random((num_permutations, len(strata)))
+    permutations = np.empty((num_permutations, len(strata)), dtype=np.intp)
+    permutations[:, order] = order[np.argsort(keys, axis=1)]
+    return permutations
+
+
+def get_permutation_pvalues(
+    df,
+    cols,
+    n_permutations=1000,
+    by=None,
+    method="pearson",
+    seed=0,
+    batch_size=100,
+):
+    """Return the matrix of two-sided permutation test p-values of the pairwise
+    correlations between `cols` of `df`.
+
+    The null distribution of each pair comes from correlating one column with the other's
+    rows permuted, only within the groups of `by` (a column or index level, such as
+    "manufacturer") if given, so that differences between the groups aren't taken as
+    evidence of correlation. Each batch of `batch_size` permutations is applied to every
+    column at once and correlated with the unpermuted columns in a single product. The
+    batches are seeded by `parallel.get_seeded_batches`, as in
+    `regression.bootstrap_col_subsets`.
+
+    `method` is "pearson" or "spearman"; as in `get_correlation_matrix`, `df` should have
+    no NaNs.
+    """
+    if method not in ("pearson", "spearman"):
+        raise ValueError(f"Unknown permutation test method {method!r}!")
+    cols = list(cols)
+    X = _standardize(df, cols, method)
+    num_rows, num_cols = X.shape
+    if by is None:
+        strata = np.zeros(num_rows)
+    else:
+        strata = df.groupby(by, sort=False).ngroup().to_numpy(dtype="float64")
+
+    rows, columns = np.triu_indices(num_cols, k=1)
+    # Allow for rounding, so that the identity permutation counts as at least as extreme.
+    observed = np.abs((X.T @ X)[rows, columns]) - 1e-12
+    counts = np.zeros(len(rows), dtype=np.int64)
+
+    seed_seqs, sizes = get_seeded_batches(n_permutations, batch_size, seed)
+    with timed("correlations:permutations", n_permutations=n_permutations):
+        for seed_seq, size in zip(seed_seqs, sizes):
+            permutations = _get_permutations(
+                np.random.default_rng(seed_seq), strata, size
             )
+            # Side by side, the permuted copies of X form a (rows x permutations * cols) block.
+            blocks = np.moveaxis(X[permutations], 0, 1).reshape(num_rows, -1)
+            null = (X.T @ blocks).reshape(num_cols, size, num_cols)
+            counts += (np.abs(null[rows, :, columns]) >= observed[:, None]).sum(axis=1)
+
+    pvalues = np.zeros((num_cols, num_cols))
+    pvalues[rows, columns] = (counts + 1) / (n_permutations + 1)
+    pvalues[columns, rows] = pvalues[rows, columns]
+    return pvalues
+
 
-    plt.savefig(f"Figures/Correlations/all.png")
+def adjust_pvalues(pvalues):
+    """Return the Benjamini-Hochberg adjusted p-values (q-values) of the 1D array
+    `pvalues`. The tests whose q-value is at most a given rate are the discoveries at that
+    false discovery rate, as used by `get_significant_correlations`."""
+    pvalues = np.asarray(pvalues, dtype="float64")
+    order = np.argsort(pvalues)
+    ranked = pvalues[order] * len(pvalues) / np.arange(1, len(pvalues) + 1)
+    qvalues = np.empty_like(pvalues)
+    qvalues[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return qvalues
 
 
-def get_significant_correlations(df, cols, sort=True, threshold=0.5):
+def get_significant_correlations(
+    df,
+    cols,
+    sort=True,
+    threshold=0.5,
+    method="pearson",
+    n_permutations=None,
+    by=None,
+    fdr=0.05,
+    seed=0,
+):
     """Given a dataframe and a list of cols, return a list of positively correlated
     column pairs and a list of negatively correlated column pairs with their correlations.
+
+    If `n_permutations` is given, also test every pair with `get_permutation_pvalues`
+    (permuting within the groups of `by`) and return a third dict mapping each pair of
+    the two lists to its p-value and whether it is significant at a false discovery rate
+    of `fdr`, adjusted over all pairs of `cols` by `adjust_pvalues`.
     """
+    cols = list(cols)
+    correlations = get_correlation_matrix(df, cols, method=method)
+    positive_correlations, negative_correlations = split_correlations(
+        correlations, cols, sort=sort, threshold=threshold
+    )
+    if n_permutations is None:
+        return positive_correlations, negative_correlations
+
+    pvalues = get_permutation_pvalues(
+        df, cols, n_permutations=n_permutations, by=by, method=method, seed=seed
+    )
+    rows, columns = np.triu_indices(len(cols), k=1)
+    qvalues = adjust_pvalues(pvalues[rows, columns])
+    tests = {
+        (cols[row], cols[column]): (float(pvalues[row, column]), bool(qvalue <= fdr))
+        for row, column, qvalue in zip(rows, columns, qvalues)
+    }
+    significance = {
+        pair: tests[pair]
+        for pair, _ in [*positive_correlations, *negative_correlations]
+    }
+    return positive_correlations, negative_correlations, significance
+
+
+def get_correlation_stats(cols):
+    """Return empty running statistics for the correlations between `cols`."""
+    cols = list(cols)
+    return {
+        "cols": cols,
+        "count": 0,
+        "mean": np.zeros(len(cols)),
+        "comoment": np.zeros((len(cols), len(cols))),
+    }
+
+
+def update_correlation_stats(stats, chunk):
+    """Add the rows of the pd.DataFrame `chunk` to the running statistics `stats` in place."""
+    X = chunk[stats["cols"]].to_numpy(dtype="float64")
+    if not len(X):
+        return stats
+    count = stats["count"]
+    chunk_count = len(X)
+    chunk_mean = X.mean(axis=0)
+    X = X - chunk_mean
+
+    # Merge the running co-moments with the chunk's (Chan et al.).
+    delta = chunk_mean - stats["mean"]
+    total = count + chunk_count
+    stats["comoment"] += X.T @ X + np.outer(delta, delta) * count * chunk_count / total
+    stats["mean"] += delta * chunk_count / total
+    stats["count"] = total
+    return stats
+
+
+def get_correlation_matrix_from_stats(stats):
+    """Return the Pearson correlation matrix described by the running statistics `stats`."""
+    scale = np.sqrt(np.diag(stats["comoment"]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return stats["comoment"] / np.outer(scale, scale)
+
+
+def get_correlation_matrix_from_chunks(chunks, cols):
+    """Return the Pearson correlation matrix between `cols` over an iterable of pd.DataFrame
+    chunks (such as `loader.iter_pdga_chunks()`), holding only one chunk at a time."""
+    stats = get_correlation_stats(cols)
+    for chunk in chunks:
+        update_correlation_stats(stats, chunk)
+    return get_correlation_matrix_from_stats(stats)
+
+
+def split_correlations(correlations, cols, sort=True, threshold=0.5):
+    """Given a correlation matrix between `cols`, return the positively and negatively
+    correlated column pairs as in `get_significant_correlations`."""
+    rows, columns = np.triu_indices(len(cols), k=1)
+    values = correlations[rows, columns]
+
     positive_correlations = dict()
     negative_correlations = dict()
-    for idx, feature_1 in enumerate(cols):
-        for feature_2 in cols[idx + 1 :]:
-            correlation = df[feature_1].corr(df[feature_2])
-            if correlation >= threshold:
-                positive_correlations[(feature_1, feature_2)] = correlation
-            elif correlation <= -threshold:
-                negative_correlations[(feature_1, feature_2)] = correlation
+    for idx in np.flatnonzero(values >= threshold):
+        positive_correlations[(cols[rows[idx]], cols[columns[idx]])] = float(
+            values[idx]
+        )
+    for idx in np.flatnonzero(values <= -threshold):
+        negative_correlations[(cols[rows[idx]], cols[columns[idx]])] = float(
+            values[idx]
+        )
 
     positive_correlations = positive_correlations.items()
     negative_correlations = negative_correlations.items()
@@ -62,28 +279,95 @@ def get_significant_correlations(df, cols, sort=True, threshold=0.5):
     return positive_correlations, negative_correlations
 
 
-def plot_significant_correlations(threshold=0.5):
+def get_significant_correlations_by(
+    df, cols, by="manufacturer", sort=True, threshold=0.5, method="pearson"
+):
+    """Return a dict mapping each group of `df` (grouped by the column or index level `by`)
+    to its positively and negatively correlated column pairs."""
+    cols = list(cols)
+    return {
+        group: split_correlations(
+            get_correlation_matrix(df_group, cols, method=method),
+            cols,
+            sort=sort,
+            threshold=threshold,
+        )
+        for group, df_group in df.groupby(by)
+    }
+
+
+def plot_significant_correlations(threshold=0.5, n_workers=None):
     df = get_df_pdga_quantitative()
     positive_correlations, negative_correlations = get_significant_correlations(
         df, list(cols_quantitative), threshold=threshold
     )
 
-    plot_correlations(
-        df, positive_correlations, fig_title="Positively correlated features"
-    )
-    plt.savefig(f"Figures/Correlations/positive_correlations.png")
-    plt.close()
+    jobs = [
+        make_job(
+            save_correlations,
+            path,
+            df,
+            correlations,
+            fig_title=fig_title,
+            file_out=path,
+        )
+        for correlations, fig_title, path in [
+            (
+                positive_correlations,
+                "Positively correlated features",
+                "Figures/Correlations/positive_correlations.png",
+            ),
+            (
+                negative_correlations,
+                "Negatively correlated features",
+                "Figures/Correlations/negative_correlations.png",
+            ),
+        ]
+    ]
+    for job in jobs:
+        job["sources"] = []
+    render_jobs(jobs, n_workers=n_workers)
+
 
-    plot_correlations(
-        df,
-        negative_correlations,
-        fig_title="Negatively correlated features",
+def analyze_correlations(
+    threshold=0.5, n_permutations=1000, by="manufacturer", fdr=0.05, seed=0
+):
+    """Print the correlated pairs of features with their permutation test p-values, where
+    discs are only permuted within their manufacturer, and whether they are significant at
+    a false discovery rate of `fdr`."""
+    df = get_df_pdga_quantitative()
+    positive_correlations, negative_correlations, significance = (
+        get_significant_correlations(
+            df,
+            list(cols_quantitative),
+            threshold=threshold,
+            n_permutations=n_permutations,
+            by=by,
+            fdr=fdr,
+            seed=seed,
+        )
     )
-    plt.savefig(f"Figures/Correlations/negative_correlations.png")
+    for pair, corr in [*positive_correlations, *negative_correlations]:
+        pvalue, significant = significance[pair]
+        print(
+            f"{pair[0]} and {pair[1]}: r = {corr:6.4f}, p = {pvalue:.4f}"
+            + ("" if significant else " (not significant)")
+        )
+    return positive_correlations, negative_correlations, significance
+
+
+def save_correlations(df, feature_pairs, fig_title, file_out, num_cols=5):
+    import matplotlib.pyplot as plt
+
+    plot_correlations(df, feature_pairs, fig_title, num_cols=num_cols)
+    with timed("savefig", path=file_out):
+        plt.savefig(file_out)
     plt.close()
 
 
 def plot_correlations(df, feature_pairs, fig_title, num_cols=5):
+    import matplotlib.pyplot as plt
+
     num_axes = len(feature_pairs)
     num_rows = ceil(num_axes / num_cols)
     fig, axes = plt.subplots(
@@ -1,4 +1,8 @@
-import matplotlib.pyplot as plt
+import os
+import pickle
+import time
+
+import numpy as np
 
 
 from sklearn.manifold import Isomap, LocallyLinearEmbedding, SpectralEmbedding, TSNE
@@ -10,19 +14,153 @@ from sklearn.decomposition import (
     TruncatedSVD,
 )
 from functools import partial
+from sklearn.base import clone
+from sklearn.metrics import pairwise_distances
+from parallel import map_shared
+from profiling import timed
+from render import fingerprint, get_density, make_job, plot_density, render_jobs
 
 
 from loader import (
     cols_quantitative,
     features,
-    normalize_df,
     get_df_innova,
     get_df_pdga_quantitative,
+    get_registry_scaler,
+    scale_df,
 )
 
+embedding_dir = os.path.join(".cache", "embeddings")
+
+
+def _uses_distances(method, distances):
+    return (
+        distances is not None
+        and isinstance(method, Isomap)
+        and method.metric == "minkowski"
+        and method.p == 2
+    )
+
+
+def _get_embedding_path(method, df_all, df_innova, distances=None):
+    """Return the path where `get_embedding` stores the embedding of its arguments."""
+    key = fingerprint(
+        method,
+        df_all[list(cols_quantitative)],
+        df_innova[list(cols_quantitative)],
+        _uses_distances(method, distances),
+    )
+    return os.path.join(embedding_dir, f"{key}.pkl")
+
+
+def get_embedding(method, df_all, df_innova, distances=None):
+    """Fit `method` to `df_all` and return it with the 2D coordinates of `df_all` and
+    `df_innova`, reusing the result stored in `embedding_dir` by an earlier call with the
+    same method parameters and data.
+
+    `distances` may hold the Euclidean distances from `df_all` and from `df_innova` to
+    `df_all` (see `get_distances`), which Euclidean Isomaps use instead of recomputing them.
+    The Isomap returned is then fit with metric="precomputed", so its `transform` takes
+    distances to `df_all` rather than measurements; it is stored apart from the Isomap fit
+    to the measurements.
+
+    Methods without a `transform`, such as TSNE and SpectralEmbedding, only embed the discs
+    they are fit to, so the coordinates of `df_innova` are those of its discs in `df_all`.
+    """
+    X_all = df_all[list(cols_quantitative)]
+    X_innova = df_innova[list(cols_quantitative)]
+    precomputed = _uses_distances(method, distances)
+    path = _get_embedding_path(method, df_all, df_innova, distances)
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    if precomputed:
+        with timed("fit:embedding", method=type(method).__name__):
+            fit = clone(method).set_params(metric="precomputed")
+            fit.fit(distances["all"])
+            embedding = (fit, fit.embedding_, fit.transform(distances["innova"]))
+    elif not hasattr(method, "transform"):
+        with timed("fit:embedding", method=type(method).__name__):
+            transformed_all = method.fit_transform(X_all)
+            embedding = (
+                method,
+                transformed_all,
+                transformed_all[_locate_rows(df_all, df_innova)],
+            )
+    else:
+        with timed("fit:embedding", method=type(method).__name__):
+            fit = method.fit(X_all)
+            embedding = (fit, fit.transform(X_all), fit.transform(X_innova))
+
+    os.makedirs(embedding_dir, exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump(embedding, f)
+    return embedding
+
+
+def _locate_rows(df_all, df_subset):
+    """Return the position in `df_all` of each disc of `df_subset`, matched by model and
+    measurements."""
+    cols = ["model"] + list(cols_quantitative)
+    discs = df_all.reset_index()[cols]
+    discs["position"] = np.arange(len(discs))
+    matched = df_subset.reset_index()[cols].merge(
+        discs.drop_duplicates(cols), how="left", on=cols
+    )
+    if matched["position"].isna().any():
+        raise ValueError("Not every disc to embed is among the discs fit!")
+    return matched["position"].to_numpy(dtype=int)
+
+
+def get_distances(df_all, df_innova):
+    """Return the Euclidean distances from the discs of `df_all` and `df_innova` to those of `df_all`."""
+    X_all = df_all[list(cols_quantitative)].to_numpy()
+    X_innova = df_innova[list(cols_quantitative)].to_numpy()
+    return {
+        "all": pairwise_distances(X_all),
+        "innova": pairwise_distances(X_innova, X_all),
+    }
+
+
+def _timed_embedding(data, method):
+    df_all, df_innova, distances = data
+    cached = os.path.exists(_get_embedding_path(method, df_all, df_innova, distances))
+    start = time.perf_counter()
+    embedding = get_embedding(method, df_all, df_innova, distances=distances)
+    return embedding, None if cached else time.perf_counter() - start
+
+
+def run_sweep(methods, df_all, df_innova, n_workers=1):
+    """Fit each of the dict `methods` with `get_embedding` across `n_workers` processes and
+    return a dict of their embeddings and a dict of the seconds each one took to fit, which
+    is None for those loaded from `embedding_dir` instead.
+
+    The distance matrix shared by Isomaps is computed once and sent to each worker once.
+    """
+    distances = None
+    if any(isinstance(method, Isomap) for method in methods.values()):
+        distances = get_distances(df_all, df_innova)
+
+    results = map_shared(
+        _timed_embedding,
+        (df_all, df_innova, distances),
+        methods.values(),
+        executor="serial" if n_workers == 1 else "processes",
+        n_workers=n_workers,
+    )
+
+    embeddings = {title: embedding for title, (embedding, _) in zip(methods, results)}
+    timings = {title: seconds for title, (_, seconds) in zip(methods, results)}
+    return embeddings, timings
+
 
 def make_plot_unlabeled(methods, file_out, dummy_method=False):
-    df = normalize_df(get_df_pdga_quantitative())
+    import matplotlib.pyplot as plt
+
+    df = scale_df(get_registry_scaler(), get_df_pdga_quantitative(), inplace=True)
 
     num_rows = len(features)
     assert (
@@ -57,15 +195,28 @@ def make_plot_unlabeled(methods, file_out, dummy_method=False):
 
     plt.setp(plt.gcf().get_axes(), xticks=[], yticks=[])
     fig.tight_layout()
-    plt.savefig(f"Figures/Dim-Reduce/{file_out}.png")
+    with timed("savefig", path=get_path(file_out)):
+        plt.savefig(get_path(file_out))
     plt.close()
 
 
-def make_plot_labeled(methods, file_out, dummy_method=False):
-    df_all = normalize_df(get_df_pdga_quantitative())
-    df_innova = normalize_df(get_df_innova())
+def make_plot_labeled(
+    methods, file_out, dummy_method=False, density=False, n_workers=1
+):
+    """Plot the 2D embedding of all discs under each of `methods`, with the Innova discs
+    colored by each flight number. If `density`, the background of all discs is drawn as
+    a single histogram image computed once per method. The methods are fit by `n_workers`
+    processes."""
+    import matplotlib.pyplot as plt
 
-    num_rows = len(features)
+    # The Innova discs are scaled like the rest of the registry, so that their embeddings
+    # are comparable with those of all discs.
+    scaler = get_registry_scaler()
+    df_all = scale_df(scaler, get_df_pdga_quantitative(), inplace=True)
+    df_innova = scale_df(scaler, get_df_innova(), inplace=True)
+    numbers = [feature for feature in features if feature in df_innova]
+
+    num_rows = len(numbers)
     assert (
         num_rows > 1
     ), f"Need to have more than one row, otherwise axs array indexing will fail!"
@@ -82,24 +233,28 @@ def make_plot_labeled(methods, file_out, dummy_method=False):
         figsize=(num_cols * 4, num_rows * 4),
     )
 
-    for ax, feature in zip(axs[:, 0], features):
+    for ax, feature in zip(axs[:, 0], numbers):
         ax.set_ylabel(f"Color = {feature}", rotation=90, size="large")
 
+    embeddings, _ = run_sweep(methods, df_all, df_innova, n_workers=n_workers)
     for col_idx, (title, method) in enumerate(methods.items()):
         axs[0, col_idx].set_title(title)
-        fit = method.fit(df_all[cols_quantitative])
-        transformed_all = fit.transform(df_all[cols_quantitative])
-        transformed_innova = fit.transform(df_innova[cols_quantitative])
-        for row_idx, feature in enumerate(features):
-            axs[row_idx, col_idx].plot(
-                transformed_all[:, 0],
-                transformed_all[:, 1],
-                alpha=0.1,
-                ls="",
-                marker="o",  # Circles
-                color="black",
-                zorder=0,
-            )
+        _, transformed_all, transformed_innova = embeddings[title]
+        if density:
+            background = get_density(transformed_all[:, 0], transformed_all[:, 1])
+        for row_idx, feature in enumerate(numbers):
+            if density:
+                plot_density(axs[row_idx, col_idx], background, cmap="Greys", zorder=0)
+            else:
+                axs[row_idx, col_idx].plot(
+                    transformed_all[:, 0],
+                    transformed_all[:, 1],
+                    alpha=0.1,
+                    ls="",
+                    marker="o",  # Circles
+                    color="black",
+                    zorder=0,
+                )
             axs[row_idx, col_idx].scatter(
                 transformed_innova[:, 0],
                 transformed_innova[:, 1],
@@ -109,11 +264,20 @@ def make_plot_labeled(methods, file_out, dummy_method=False):
 
     plt.setp(plt.gcf().get_axes(), xticks=[], yticks=[])
     fig.tight_layout()
-    plt.savefig(f"Figures/Dim-Reduce/{file_out}.png")
+    with timed("savefig", path=get_path(file_out)):
+        plt.savefig(get_path(file_out))
     plt.close()
 
 
-def make_isomap_plot():
+def get_path(file_out):
+    return f"Figures/Dim-Reduce/{file_out}.png"
+
+
+def labeled_job(methods, file_out):
+    return make_job(make_plot_labeled, get_path(file_out), methods, file_out=file_out)
+
+
+def isomap_job():
     file_out = "isomap"
     nbd_sizes = [1, 3, 5, 10, 15]
     methods = {
@@ -122,20 +286,20 @@ def make_isomap_plot():
         )
         for nbd_size in nbd_sizes
     }
-    make_plot_labeled(methods, file_out=file_out)
+    return labeled_job(methods, file_out)
 
 
-def make_tsne_plot():
+def tsne_job():
     file_out = "tsne"
     perplexities = [5, 10, 15, 20, 25]
     methods = {
         f"TSNE(perplexity = {perplexity})": TSNE(perplexity=perplexity)
         for perplexity in perplexities
     }
-    make_plot_labeled(methods, file_out=file_out)
+    return labeled_job(methods, file_out)
 
 
-def make_pca_plot():
+def pca_job():
     file_out = "pca"
     n_components = 2
     methods = {
@@ -145,10 +309,10 @@ def make_pca_plot():
         "SparsePCA": SparsePCA(n_components=n_components),
         "TruncatedSVD": TruncatedSVD(n_components=n_components),
     }
-    make_plot_labeled(methods, file_out=file_out)
+    return labeled_job(methods, file_out)
 
 
-def make_LLE_neighbors_plot():
+def LLE_neighbors_job():
     file_out = "lle_neighbors"
     nbd_sizes = range(10, 20, 2)
     methods = {
@@ -157,18 +321,19 @@ def make_LLE_neighbors_plot():
         )
         for nbd_size in nbd_sizes
     }
-    make_plot_labeled(methods, file_out=file_out)
+    return labeled_job(methods, file_out)
 
 
-def make_LLE_methods_plot():
+def LLE_methods_job():
     file_out = "lle_methods"
     n_components = 2
     n_neighbors = 30
+    # ARPACK finds the Hessian and LTSA problems of these discs exactly singular.
     LLE = partial(
         LocallyLinearEmbedding,
         n_neighbors=n_neighbors,
         n_components=n_components,
-        eigen_solver="auto",
+        eigen_solver="dense",
     )
     methods = {
         "LLE": LLE(method="standard"),
@@ -176,19 +341,19 @@ def make_LLE_methods_plot():
         "Hessian LLE": LLE(method="hessian"),
         "Modified LLE": LLE(method="modified"),
     }
-    make_plot_labeled(methods, file_out=file_out)
+    return labeled_job(methods, file_out)
 
 
-def make_spectral_plot():
+def spectral_job():
     file_out = "spectral"
     methods = {
         "Spectral NN": SpectralEmbedding(affinity="nearest_neighbors"),
         "Spectral RBF": SpectralEmbedding(affinity="rbf"),
     }
-    make_plot_labeled(methods, file_out=file_out)
+    return labeled_job(methods, file_out)
 
 
-def make_methods_plot(labeled=True):
+def methods_job(labeled=True):
     file_out = "methods"
     n_components = 2
     n_neighbors = 20
@@ -204,9 +369,54 @@ def make_methods_plot(labeled=True):
         # f"TSNE(perplexity = {n_neighbors})": TSNE(perplexity=n_neighbors),
     }
     if labeled:
-        make_plot_labeled(methods, file_out=f"{file_out}_labeled")
+        return labeled_job(methods, f"{file_out}_labeled")
     else:
-        make_plot_unlabeled(methods, file_out=f"{file_out}_unlabeled")
+        file_out = f"{file_out}_unlabeled"
+        return make_job(
+            make_plot_unlabeled, get_path(file_out), methods, file_out=file_out
+        )
+
+
+def make_isomap_plot():
+    render_jobs([isomap_job()])
+
+
+def make_tsne_plot():
+    render_jobs([tsne_job()])
+
+
+def make_pca_plot():
+    render_jobs([pca_job()])
+
+
+def make_LLE_neighbors_plot():
+    render_jobs([LLE_neighbors_job()])
+
+
+def make_LLE_methods_plot():
+    render_jobs([LLE_methods_job()])
+
+
+def make_spectral_plot():
+    render_jobs([spectral_job()])
+
+
+def make_methods_plot(labeled=True):
+    render_jobs([methods_job(labeled=labeled)])
+
+
+def make_all_plots(n_workers=None):
+    """Render every figure in Figures/Dim-Reduce across `n_workers` processes."""
+    jobs = [
+        isomap_job(),
+        tsne_job(),
+        pca_job(),
+        LLE_neighbors_job(),
+        LLE_methods_job(),
+        spectral_job(),
+        methods_job(labeled=True),
+    ]
+    render_jobs(jobs, n_workers=n_workers)
 
 
 if __name__ == "__main__":
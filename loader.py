@@ -1,5 +1,12 @@
+import json
+import os
+import time
+
+import numpy as np
 import pandas as pd
 
+from profiling import timer
+
 cols_aux = [
     "class",
     "max_weight_vint",
@@ -27,66 +34,491 @@ features = {
     "stability": (-5, 7),
 }
 
+# Flight number tables, in the format of innova.csv, of the manufacturers publishing them.
+flight_tables = {"Innova Champion Discs": "innova.csv"}
+flight_numbers = ["speed", "glide", "turn", "fade"]
+
+# Names of the levels of the normalized (manufacturer, model) keys of the join index.
+cols_join_key = ["manufacturer_key", "model_key"]
+
+# Parsed source files, keyed by path and reader and validated against (mtime, size).
+_cache = dict()
+_cache_stats = {"hits": 0, "misses": 0}
+
 
 def get_df_innova(include_max_weight=True, include_stability=False):
     """Return a pd.DataFrame with the PDGA-registered physical features and flight numbers of each Innova disc."""
-    discs_innova = get_df_by_mfr("Innova Champion Discs")
-
-    numbers_innova = pd.read_csv(
-        "innova.csv",
-        names=["model", "speed", "glide", "turn", "fade", "abbreviation"],
-        index_col="model",
-        usecols=["model", "speed", "glide", "turn", "fade"],
-        sep="\t",
+    manufacturer = "Innova Champion Discs"
+    df, _ = join_flight_numbers(
+        {manufacturer: flight_tables[manufacturer]},
+        include_stability=include_stability,
     )
+    df = df.droplevel("manufacturer")
     if not include_max_weight:
-        discs_innova.drop(columns="max_weight", inplace=True)
+        df = df.drop(columns="max_weight")
+    return df
+
+
+def normalize_key(name):
+    """Return `name` casefolded and with its whitespace collapsed, so that a disc matches
+    across the registry and the flight number tables despite differences in spelling,
+    such as the "CRO" and "ORC" of the registry and the "Cro" and "Orc" of innova.csv.
+    """
+    return " ".join(name.split()).casefold()
 
+
+def _index_by_key(df):
+    """Return `df` indexed by the normalized keys of its manufacturer and model columns."""
+    keys = [df[col].map(normalize_key).to_numpy() for col in cols_qualitative]
+    return df.set_index(pd.MultiIndex.from_arrays(keys, names=cols_join_key))
+
+
+def _read_registry_index(path):
+    return _index_by_key(read_cached(path, _read_pdga).dropna()).sort_index()
+
+
+def get_registry_index():
+    """Return the registered discs with no null measurements, indexed by their normalized
+    (manufacturer, model) keys. The index is built once per version of pdga.csv."""
+    return read_cached("pdga.csv", _read_registry_index)
+
+
+def get_flight_numbers(tables=None, include_stability=False):
+    """Return the flight numbers in `tables` indexed by normalized (manufacturer, model)
+    keys.
+
+    `tables` maps manufacturers to their flight numbers, each a pd.DataFrame indexed by
+    model or the path of a file in the format of innova.csv (by default, `flight_tables`).
+    """
+    tables = flight_tables if tables is None else tables
+    numbers = []
+    for manufacturer, table in tables.items():
+        if isinstance(table, str):
+            table = read_cached(table, _read_innova)
+        table = table[flight_numbers].astype("float64")
+        table.index = pd.MultiIndex.from_arrays(
+            [
+                [normalize_key(manufacturer)] * len(table),
+                table.index.map(normalize_key),
+            ],
+            names=cols_join_key,
+        )
+        numbers.append(table)
+    numbers = pd.concat(numbers)
     if include_stability:
-        numbers_innova["stability"] = numbers_innova["turn"] + numbers_innova["fade"]
+        numbers["stability"] = numbers["turn"] + numbers["fade"]
+    return numbers
+
+
+def join_flight_numbers(tables=None, discs=None, include_stability=False):
+    """Join the flight numbers in `tables` (see `get_flight_numbers`) to the discs in
+    `discs` (by default, all registered discs with no null measurements) in a single
+    hash join on normalized (manufacturer, model) keys.
+
+    Return the joined pd.DataFrame, indexed by manufacturer and model, and a pd.DataFrame
+    of the keys in `tables` that match no disc. Neither the arguments nor any module
+    state are modified, so this is safe to call repeatedly and from worker processes.
+    """
+    numbers = get_flight_numbers(tables, include_stability=include_stability)
+    discs = get_registry_index() if discs is None else _index_by_key(discs)
+    joined = discs.join(numbers, how="inner")
+    unmatched = numbers.index.unique().difference(discs.index).to_frame(index=False)
+    return joined.set_index(cols_qualitative).sort_index(), unmatched
+
+
+def normalize_df(df, bounds=None, inplace=False):
+    """Given a dataframe with quantitative columns, normalize them to lie between 0 and 1.
+
+    If given, `bounds` is a pd.DataFrame with rows "min" and "max" (as returned by
+    `get_bounds_from_chunks`) used instead of the columns' own minima and maxima. See
+    `scale_df` for `inplace`.
+    """
+    cols = list(df.columns)
+    if bounds is None:
+        scaler = get_scaler(df, cols)
     else:
-        del features["stability"]
+        scaler = {
+            "cols": cols,
+            "min": bounds.loc["min", cols].to_numpy(dtype="float64"),
+            "max": bounds.loc["max", cols].to_numpy(dtype="float64"),
+        }
+    return scale_df(scaler, df, inplace=inplace)
 
-    return discs_innova.join(numbers_innova, how="inner").astype(
-        {feature: "float64" for feature in features}
-    )
+
+def get_scaler(df=None, cols=None):
+    """Return the minima and maxima of `cols` (by default, the quantitative columns) over
+    the rows of `df`, or bounds to be widened by `update_scaler` if `df` is None.
+
+    The scaler is a dict with keys "cols", "min" and "max". It can be fit once, e.g. to
+    the whole registry by `get_registry_scaler`, and applied by `scale_df` to any subset
+    of discs or to new ones, so that they all end up on the same scale.
+    """
+    cols = list(cols_quantitative) if cols is None else list(cols)
+    scaler = {
+        "cols": cols,
+        "min": np.full(len(cols), np.inf),
+        "max": np.full(len(cols), -np.inf),
+    }
+    if df is not None:
+        update_scaler(scaler, df)
+    return scaler
+
+
+def update_scaler(scaler, df):
+    """Widen the bounds of `scaler` in place to cover the rows of `df`, ignoring nulls."""
+    X = df[scaler["cols"]].to_numpy(dtype="float64")
+    if len(X):
+        np.fmin(scaler["min"], np.fmin.reduce(X, axis=0), out=scaler["min"])
+        np.fmax(scaler["max"], np.fmax.reduce(X, axis=0), out=scaler["max"])
 
 
-def normalize_df(df):
-    """Given a dataframe with quantitative columns, normalize them to lie between 0 and 1."""
-    df = df.copy(deep=True)
-    for col in df.columns:
-        col_min = min(df[col])
-        col_max = max(df[col])
-        df[col] = (df[col] - col_min) / (col_max - col_min)
+def scale_array(scaler, X, out=None):
+    """Return the array `X`, whose columns are `scaler["cols"]`, scaled to lie between 0
+    and 1, writing the result into `out` (which may be `X` itself) if given."""
+    out = np.subtract(X, scaler["min"], out=out)
+    return np.divide(out, scaler["max"] - scaler["min"], out=out)
+
+
+def scale_df(scaler, df, inplace=False):
+    """Return `df` with the columns of `scaler` scaled to lie between 0 and 1.
+
+    The scaled columns are computed in a single array; if `inplace` they replace the
+    columns of `df` itself, and otherwise a shallow copy of `df`, so that the remaining
+    columns are never copied.
+    """
+    cols = scaler["cols"]
+    X = df[cols].to_numpy(dtype="float64", copy=True)
+    scale_array(scaler, X, out=X)
+    if not inplace:
+        df = df.copy(deep=False)
+    df[cols] = X
     return df
 
 
+def get_registry_scaler():
+    """Return the scaler fit to all discs of `get_df_pdga_quantitative`.
+
+    It is stored next to the snapshot of pdga.csv and refit only when pdga.csv changes.
+    """
+    path = os.path.join(snapshot_dir("pdga.csv"), "scaler.json")
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        source = source_key("pdga.csv")
+        if all(saved.get(key) == value for key, value in source.items()):
+            return {
+                "cols": saved["cols"],
+                "min": np.array(saved["min"], dtype="float64"),
+                "max": np.array(saved["max"], dtype="float64"),
+            }
+    except (OSError, ValueError, KeyError):
+        pass
+
+    scaler = get_scaler(get_df_pdga_quantitative())
+    save_registry_scaler(scaler)
+    return scaler
+
+
+def save_registry_scaler(scaler):
+    """Store `scaler` as the scaler of the current pdga.csv for `get_registry_scaler`."""
+    directory = snapshot_dir("pdga.csv")
+    os.makedirs(directory, exist_ok=True)
+    saved = dict(
+        source_key("pdga.csv"),
+        cols=scaler["cols"],
+        min=scaler["min"].tolist(),
+        max=scaler["max"].tolist(),
+    )
+    with open(os.path.join(directory, "scaler.json"), "w") as f:
+        json.dump(saved, f)
+
+
+def get_bounds_from_chunks(chunks, cols=None):
+    """Return a pd.DataFrame with the minimum and maximum of each of `cols` (by default, the
+    quantitative columns) over an iterable of pd.DataFrame chunks."""
+    cols = list(cols_quantitative) if cols is None else list(cols)
+    col_min = None
+    col_max = None
+    for chunk in chunks:
+        chunk_min = chunk[cols].min()
+        chunk_max = chunk[cols].max()
+        col_min = chunk_min if col_min is None else np.fmin(col_min, chunk_min)
+        col_max = chunk_max if col_max is None else np.fmax(col_max, chunk_max)
+    return pd.DataFrame([col_min, col_max], index=["min", "max"])
+
+
 def get_df_by_mfr(manufacturer):
     """Return a pd.DataFrame with the PDGA-registered physical features."""
-    discs_all = get_df_pdga().dropna()
-    discs_subset = discs_all[discs_all.manufacturer == manufacturer]
-    discs_subset = discs_subset[["model"] + list(cols_quantitative)]
-    discs_subset.reset_index(drop=True, inplace=True)
-    discs_subset.set_index("model", inplace=True)
+    registry = get_registry_index()
+    try:
+        discs_subset = registry.xs(
+            normalize_key(manufacturer), level="manufacturer_key"
+        )
+    except KeyError:
+        discs_subset = registry.iloc[:0]
+    discs_subset = discs_subset.set_index("model")[list(cols_quantitative)]
     return discs_subset.sort_index()
 
 
-def get_df_pdga():
-    """Return a pd.DataFrame with all PDGA-registered discs."""
-    pdga = "pdga.csv"
-    discs_all = pd.read_csv(
-        pdga,
+def get_df_pdga(compact=False):
+    """Return a pd.DataFrame with all PDGA-registered discs, in the representation of
+    `compact_df` if `compact`.
+
+    The compact registry is cached on its own, so that the full one isn't kept alongside.
+    """
+    if compact:
+        return read_cached("pdga.csv", _read_pdga_compact)
+    return read_cached("pdga.csv", _read_pdga)
+
+
+def _read_pdga_compact(path):
+    return compact_df(_read_pdga(path))
+
+
+def compact_df(df, decimals=None):
+    """Return a copy of `df` with its qualitative columns stored as categoricals and its
+    quantitative columns as float32.
+
+    The registry records measurements with at most `decimals` decimal places (by default,
+    as many as any of them has; see `get_decimals`), and the 7 significant digits of a
+    float32 are enough to recover each of them by rounding. This is checked before
+    returning, raising ValueError if any can't be recovered.
+    """
+    if decimals is None:
+        decimals = get_decimals(df)
+    dtypes = {col: "category" for col in cols_qualitative if col in df}
+    dtypes.update({col: "float32" for col in cols_quantitative if col in df})
+    compact = df.astype(dtypes)
+    error = check_compact_precision(df, compact, decimals=decimals)
+    if error != 0:
+        raise ValueError(
+            f"float32 can't hold the measurements to {decimals} decimal places "
+            f"(max. error {error})!"
+        )
+    return compact
+
+
+def get_decimals(df, max_decimals=15):
+    """Return the most decimal places of any quantitative value of `df`, counting at most
+    `max_decimals`."""
+    cols = [col for col in cols_quantitative if col in df]
+    X = df[cols].to_numpy(dtype="float64")
+    X = X[~np.isnan(X)]
+    for decimals in range(max_decimals):
+        if np.array_equal(np.round(X, decimals), X):
+            return decimals
+    return max_decimals
+
+
+def check_compact_precision(df, compact, decimals=2):
+    """Return the largest difference between a quantitative value of `df` and its float32
+    value in `compact` rounded to `decimals` decimal places."""
+    cols = [col for col in cols_quantitative if col in df]
+    original = df[cols].to_numpy(dtype="float64")
+    recovered = np.round(compact[cols].to_numpy(dtype="float64"), decimals)
+    return float(np.nanmax(np.abs(recovered - original), initial=0))
+
+
+def memory_report(df=None):
+    """Return the memory in bytes of the registry (or `df`) before and after `compact_df`."""
+    if df is None:
+        df = get_df_pdga()
+    before = int(df.memory_usage(deep=True).sum())
+    after = int(compact_df(df).memory_usage(deep=True).sum())
+    return {"before": before, "after": after, "ratio": after / before}
+
+
+def _read_pdga(path):
+    df = read_snapshot(path)
+    if df is None:
+        df = _read_pdga_csv(path)
+        write_snapshot(path, df)
+    return df
+
+
+@timer("load:pdga.csv")
+def _read_pdga_csv(path):
+    return pd.read_csv(
+        path,
         header=0,
         names=cols_qualitative + list(cols_quantitative) + cols_aux,
         usecols=cols_qualitative + list(cols_quantitative),
     )
-    return discs_all
 
 
-def get_df_pdga_quantitative():
+@timer("load:innova.csv")
+def _read_innova(path):
+    return pd.read_csv(
+        path,
+        names=["model", "speed", "glide", "turn", "fade", "abbreviation"],
+        index_col="model",
+        usecols=["model", "speed", "glide", "turn", "fade"],
+        sep="\t",
+    )
+
+
+def read_cached(path, reader):
+    """Return a copy of `reader(path)`, parsing the file only when its mtime or size changed."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    entry = _cache.get((path, reader))
+    if entry is not None and entry[0] == key:
+        _cache_stats["hits"] += 1
+    else:
+        _cache_stats["misses"] += 1
+        entry = (key, reader(path))
+        _cache[path, reader] = entry
+
+    # Callers routinely modify the result in place, so hand out a copy.
+    return entry[1].copy()
+
+
+def snapshot_dir(path):
+    """Return the directory holding the binary column snapshot of the CSV at `path`."""
+    path = os.path.abspath(path)
+    return os.path.join(
+        os.path.dirname(path), ".cache", os.path.basename(path) + ".snapshot"
+    )
+
+
+def source_key(path):
+    """Return the modification time and size of the file at `path`, which identify the
+    version of it that a cache was built from."""
+    stat = os.stat(path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def write_snapshot(path, df):
+    """Store `df`, parsed from the CSV at `path`, as one .npy file per column.
+
+    Quantitative columns are stored as float64 so that the snapshot round-trips exactly,
+    and qualitative columns as int32 category codes plus a table of categories.
+    """
+    directory = snapshot_dir(path)
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        # Invalidate the old snapshot before overwriting any of its columns.
+        os.remove(meta_path)
+
+    for col in cols_qualitative:
+        categorical = pd.Categorical(df[col])
+        np.save(
+            os.path.join(directory, f"{col}.codes.npy"),
+            categorical.codes.astype("int32"),
+        )
+        np.save(
+            os.path.join(directory, f"{col}.categories.npy"),
+            np.asarray(categorical.categories, dtype=str),
+        )
+    for col in cols_quantitative:
+        np.save(
+            os.path.join(directory, f"{col}.npy"), df[col].to_numpy(dtype="float64")
+        )
+
+    meta = dict(source_key(path), columns=list(df.columns), num_rows=len(df))
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
+@timer("load:snapshot")
+def read_snapshot(path, mmap_mode="r"):
+    """Return the snapshot of the CSV at `path` as a pd.DataFrame, or None if it is
+    missing or older than the CSV."""
+    directory = snapshot_dir(path)
+    try:
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    source = source_key(path)
+    if any(meta.get(key) != value for key, value in source.items()):
+        return None
+
+    columns = dict()
+    for col in meta["columns"]:
+        if col in cols_qualitative:
+            codes = np.load(
+                os.path.join(directory, f"{col}.codes.npy"), mmap_mode=mmap_mode
+            )
+            categories = np.load(os.path.join(directory, f"{col}.categories.npy"))
+            columns[col] = pd.Categorical.from_codes(codes, categories).astype(str)
+        else:
+            columns[col] = np.load(
+                os.path.join(directory, f"{col}.npy"), mmap_mode=mmap_mode
+            )
+    return pd.DataFrame(columns)
+
+
+def compare_cold_start(path="pdga.csv", repeat=5):
+    """Return the best-of-`repeat` seconds taken to load the registry from the CSV and from its snapshot."""
+    if read_snapshot(path) is None:
+        write_snapshot(path, _read_pdga_csv(path))
+
+    timings = dict()
+    for name, reader in [("csv", _read_pdga_csv), ("snapshot", read_snapshot)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            reader(path)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+
+def invalidate_cache(path=None):
+    """Drop the cached parse of `path`, or of every file if `path` is None."""
+    if path is None:
+        _cache.clear()
+    else:
+        path = os.path.abspath(path)
+        for cached_path, reader in list(_cache):
+            if cached_path == path:
+                del _cache[cached_path, reader]
+
+
+def cache_stats():
+    """Return the number of cache hits and misses and the currently cached files."""
+    return dict(_cache_stats, files=sorted({path for path, _ in _cache}))
+
+
+def iter_pdga_chunks(
+    path="pdga.csv",
+    chunksize=10000,
+    manufacturer=None,
+    dropna=True,
+    include_cert_number=False,
+):
+    """Yield the registry at `path` as pd.DataFrames of at most `chunksize` rows, restricted
+    to `manufacturer` if given and without discs having null entries if `dropna`, so that
+    arbitrarily large registries can be processed in bounded memory."""
+    usecols = cols_qualitative + list(cols_quantitative)
+    if include_cert_number:
+        usecols.append("cert_number")
+    reader = pd.read_csv(
+        path,
+        header=0,
+        names=cols_qualitative + list(cols_quantitative) + cols_aux,
+        usecols=usecols,
+        dtype={col: "float64" for col in cols_quantitative},
+        chunksize=chunksize,
+    )
+    with reader:
+        for chunk in reader:
+            if manufacturer is not None:
+                chunk = chunk[chunk.manufacturer == manufacturer]
+            if dropna:
+                chunk = chunk.dropna(subset=cols_qualitative + list(cols_quantitative))
+            if len(chunk):
+                yield chunk
+
+
+def get_df_pdga_quantitative(compact=False):
     """Return a pd.DataFrame with all PDGA-registered discs and their quantitative features."""
-    discs_all = get_df_pdga().dropna()
+    discs_all = get_df_pdga(compact=compact).dropna()
     discs_all.reset_index(drop=True, inplace=True)
     discs_all.set_index(cols_qualitative, inplace=True)
     return discs_all.sort_index()
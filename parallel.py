@@ -0,0 +1,48 @@
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+# Shared argument of the map being run by this worker process; see `map_shared`.
+_worker_shared = None
+
+
+def _set_worker_shared(shared):
+    global _worker_shared
+    _worker_shared = shared
+
+
+def _call_worker(func, *args):
+    return func(_worker_shared, *args)
+
+
+def map_shared(func, shared, *iterables, executor="serial", n_workers=None):
+    """Return the list of `func(shared, *args)` for each `args` in `zip(*iterables)`, in
+    order, computed by `n_workers` workers.
+
+    `executor` is one of "serial", "threads" or "processes". Worker processes receive
+    `shared` once when they start rather than with every call, and `func` must be defined
+    at the top level of a module so that they can import it.
+    """
+    if executor == "serial":
+        return list(map(partial(func, shared), *iterables))
+    if executor == "threads":
+        with ThreadPoolExecutor(n_workers) as pool:
+            return list(pool.map(partial(func, shared), *iterables))
+    if executor == "processes":
+        with ProcessPoolExecutor(
+            n_workers, initializer=_set_worker_shared, initargs=(shared,)
+        ) as pool:
+            return list(pool.map(partial(_call_worker, func), *iterables))
+    raise ValueError(f"Unknown executor {executor!r}!")
+
+
+def get_seeded_batches(size, batch_size, seed):
+    """Split `size` random draws into batches of at most `batch_size` and return the list
+    of seed sequences and the list of sizes of the batches.
+
+    Each batch is seeded by its own child of `np.random.SeedSequence(seed)`, so that the
+    draws depend only on `seed` and `batch_size` and not on which worker makes them.
+    """
+    sizes = [min(batch_size, size - start) for start in range(0, size, batch_size)]
+    return np.random.SeedSequence(seed).spawn(len(sizes)), sizes
@@ -0,0 +1,260 @@
+import json
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from loader import (
+    cols_quantitative,
+    get_df_innova,
+    get_df_pdga_quantitative,
+    source_key,
+)
+from profiling import timed
+
+predictor_path = os.path.join(".cache", "predictor.pkl")
+
+# The files the predictor is fit to; it is refit whenever either of them changes.
+sources = ["pdga.csv", "innova.csv"]
+
+
+def _get_source_keys():
+    return {path: source_key(path) for path in sources}
+
+
+def fit_predictor(degree=1, cols=None, targets=("speed", "glide", "turn", "fade")):
+    """Return a predictor of the flight numbers `targets` from the measurements `cols`
+    (all of them by default), fit to the Innova discs with a degree-`degree` regression.
+    """
+    from sklearn.linear_model import LinearRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import PolynomialFeatures, StandardScaler
+
+    cols = list(cols_quantitative) if cols is None else list(cols)
+    targets = list(targets)
+    df = get_df_innova(include_stability="stability" in targets)
+
+    # LinearRegression fits every target with a single least-squares solve.
+    model = make_pipeline(
+        StandardScaler(), PolynomialFeatures(degree), LinearRegression()
+    )
+    with timed("fit:predictor"):
+        model.fit(df[cols], df[targets])
+    return {
+        "model": model,
+        "degree": degree,
+        "cols": cols,
+        "targets": targets,
+        "sources": _get_source_keys(),
+    }
+
+
+def save_predictor(predictor, path=predictor_path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump(predictor, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_predictor(path=predictor_path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def predict_df(predictor, df):
+    """Return a pd.DataFrame with the predicted flight numbers of each disc in `df`."""
+    return pd.DataFrame(
+        predictor["model"].predict(df[predictor["cols"]]),
+        index=df.index,
+        columns=predictor["targets"],
+    )
+
+
+def predict_registry(predictor, manufacturer="Innova Champion Discs"):
+    """Return the predicted flight numbers of every registered disc not made by `manufacturer`."""
+    df = get_df_pdga_quantitative()
+    df = df[df.index.get_level_values("manufacturer") != manufacturer]
+    return predict_df(predictor, df)
+
+
+def _collect_batch(requests, max_batch, max_wait):
+    """Block until a request arrives on the queue `requests`, then return it together with
+    any others arriving within `max_wait` seconds, up to `max_batch` in total."""
+    batch = [requests.get()]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < max_batch:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(requests.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _predict_records(predictor, batch):
+    """Given a list of lists of discs (dicts of measurements), predict all of them at once
+    and return the list of lists of predictions."""
+    records = [record for discs in batch for record in discs]
+    if not records:
+        return [[] for discs in batch]
+    predictions = predict_df(predictor, pd.DataFrame(records)).to_dict("records")
+
+    results = []
+    for discs in batch:
+        results.append(predictions[: len(discs)])
+        predictions = predictions[len(discs) :]
+    return results
+
+
+def _predict_batch(predictor, batch):
+    """Return the predictions of `_predict_records`, except that if the batch fails, each
+    list of discs is predicted on its own and those that still fail get their exception in
+    place of their predictions, so that a bad request doesn't fail the rest."""
+    try:
+        return _predict_records(predictor, batch)
+    except Exception:
+        results = []
+        for discs in batch:
+            try:
+                [predictions] = _predict_records(predictor, [discs])
+            except Exception as error:
+                predictions = error
+            results.append(predictions)
+        return results
+
+
+def _parse_discs(text):
+    """Return the list of discs in the JSON `text`, which holds a disc (a dict of
+    measurements) or a list of discs, raising ValueError if it holds anything else."""
+    discs = json.loads(text)
+    if isinstance(discs, dict):
+        return [discs]
+    if not isinstance(discs, list) or not all(isinstance(d, dict) for d in discs):
+        raise ValueError("Expected a disc or a list of discs!")
+    return discs
+
+
+def _format_error(error):
+    # The message becomes the reason phrase of an HTTP status line, so it must be one line.
+    return {"error": " ".join(f"{type(error).__name__}: {error}".split())}
+
+
+def serve_stdin(predictor, max_batch=256, max_wait=0.005):
+    """Read discs as JSON (a dict or a list of dicts) from each line of stdin and write their
+    predictions as JSON to stdout, batching the lines that arrive close together.
+
+    A line that can't be parsed or predicted gets a JSON object with its "error" instead.
+    """
+    lines = queue.Queue()
+
+    def read_lines():
+        for line in sys.stdin:
+            if line.strip():
+                lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=read_lines, daemon=True).start()
+    while True:
+        batch = _collect_batch(lines, max_batch, max_wait)
+        done = batch[-1] is None
+        parsed = []
+        for line in batch:
+            if line is None:
+                continue
+            try:
+                parsed.append(_parse_discs(line))
+            except ValueError as error:
+                parsed.append(error)
+        results = iter(
+            _predict_batch(
+                predictor,
+                [discs for discs in parsed if not isinstance(discs, Exception)],
+            )
+        )
+        for discs in parsed:
+            predictions = discs if isinstance(discs, Exception) else next(results)
+            if isinstance(predictions, Exception):
+                predictions = _format_error(predictions)
+            print(json.dumps(predictions))
+        sys.stdout.flush()
+        if done:
+            return
+
+
+def serve_http(predictor, port=8000, max_batch=256, max_wait=0.005):
+    """Serve predictions for discs POSTed as JSON to /predict on `port`, batching concurrent
+    requests into a single prediction."""
+    requests = queue.Queue()
+
+    def predict_batches():
+        while True:
+            batch = _collect_batch(requests, max_batch, max_wait)
+            # This is the only batching thread, so whatever goes wrong is sent back to the
+            # waiting requests rather than allowed to end it.
+            try:
+                results = _predict_batch(predictor, [discs for discs, _ in batch])
+            except Exception as error:
+                results = [error] * len(batch)
+            for (_, reply), predictions in zip(batch, results):
+                reply.put(predictions)
+
+    threading.Thread(target=predict_batches, daemon=True).start()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                discs = _parse_discs(self.rfile.read(length))
+            except ValueError as error:
+                self.send_error(400, _format_error(error)["error"])
+                return
+
+            reply = queue.Queue(maxsize=1)
+            requests.put((discs, reply))
+            predictions = reply.get()
+            if isinstance(predictions, Exception):
+                self.send_error(400, _format_error(predictions)["error"])
+                return
+
+            body = json.dumps(predictions).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+def get_predictor(degree=1, path=predictor_path):
+    """Load the predictor saved at `path`, fitting and saving it first if it is missing,
+    of another degree or fit before pdga.csv or innova.csv last changed."""
+    try:
+        predictor = load_predictor(path)
+        if (
+            predictor["degree"] == degree
+            and predictor.get("sources") == _get_source_keys()
+        ):
+            return predictor
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    predictor = fit_predictor(degree=degree)
+    save_predictor(predictor, path)
+    return predictor
+
+
+if __name__ == "__main__":
+    from cli import get_parser
+
+    args = get_parser().parse_args(["predict", *sys.argv[1:]])
+    args.func(args)
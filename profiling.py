@@ -0,0 +1,102 @@
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+
+# Set DISC_GOLF_PROFILE to a non-empty value to record timings, and DISC_GOLF_TRACE to the
+# path of the JSON trace written at exit (.cache/trace.json by default).
+enabled = bool(os.environ.get("DISC_GOLF_PROFILE"))
+trace_path = os.environ.get("DISC_GOLF_TRACE", os.path.join(".cache", "trace.json"))
+
+events = []
+_start = time.perf_counter()
+
+
+@contextmanager
+def timed(stage, **details):
+    """Record the wall time of the enclosed block as an event of `stage` with `details`."""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        events.append(
+            dict(
+                stage=stage,
+                start=start - _start,
+                seconds=end - start,
+                pid=os.getpid(),
+                **details,
+            )
+        )
+
+
+def timer(stage):
+    """Decorate a function so that each call is recorded as an event of `stage`.
+
+    When profiling is disabled the function is returned as is, so that timing functions
+    called in tight loops costs nothing.
+    """
+
+    def decorator(func):
+        if not enabled:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def summarize(events=events):
+    """Return a dict mapping each stage to its number of events and their total, mean and
+    maximum seconds."""
+    summary = dict()
+    for event in events:
+        stats = summary.setdefault(
+            event["stage"], {"count": 0, "total": 0.0, "max": 0.0}
+        )
+        stats["count"] += 1
+        stats["total"] += event["seconds"]
+        stats["max"] = max(stats["max"], event["seconds"])
+    for stats in summary.values():
+        stats["mean"] = stats["total"] / stats["count"]
+    return summary
+
+
+def format_summary(summary):
+    lines = [f"{'stage':<28} {'count':>7} {'total':>10} {'mean':>10} {'max':>10}"]
+    for stage, stats in sorted(summary.items(), key=lambda x: -x[1]["total"]):
+        lines.append(
+            f"{stage:<28} {stats['count']:>7} {stats['total']:>10.4f} "
+            f"{stats['mean']:>10.6f} {stats['max']:>10.4f}"
+        )
+    return "\n".join(lines)
+
+
+def write_trace(path=trace_path):
+    """Write the recorded events and their summary to `path` as JSON."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"events": events, "summary": summarize()}, f, indent=2)
+
+
+def _report():
+    if events:
+        write_trace()
+        print(format_summary(summarize()), file=sys.stderr)
+
+
+if enabled:
+    atexit.register(_report)
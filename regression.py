@@ -1,20 +1,23 @@
-import matplotlib
-import matplotlib.cm as cm
-import matplotlib.pyplot as pp
-from matplotlib import ticker
-
-matplotlib.rcParams["text.usetex"] = True
-
 import numpy as np
 import pandas as pd
 
 from collections import Counter
 from itertools import combinations
-from sklearn.linear_model import LinearRegression, ElasticNet
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.pipeline import make_pipeline
 
 from loader import get_df_innova, cols_quantitative, features
+from parallel import get_seeded_batches, map_shared
+from profiling import timed, timer
+from render import make_job, render_jobs
+
+# matplotlib and sklearn are imported by the functions that use them, so that importing
+# this module for the least-squares machinery stays fast.
+
+# rcParams of the regression figures, which are typeset with LaTeX.
+style = {"text.usetex": True}
+
+# Solving the normal equations loses about as many digits as the condition number of the
+# Gram matrix has, so subsets beyond this one are solved from their design matrix instead.
+max_condition = 1e6
 
 
 def curve_type(degree):
@@ -23,70 +26,869 @@ def curve_type(degree):
     )
 
 
-def get_col_subsets(df, cols, feature_to_predict, num_cols, threshold, degree=1):
+def expand_cols(df, cols, degree=1, center=None, scale=None):
+    """Return the polynomial features of the standardized `cols` of `df` together with
+    the exponent of each column in each feature.
+
+    Standardizing doesn't change the span of the polynomial features but keeps their
+    Gram matrix well-conditioned. Any fixed `center` and `scale` work equally well, so
+    that features of rows added later can be computed consistently.
+    """
+    X = df[list(cols)].to_numpy(dtype="float64")
+    if center is None:
+        center = X.mean(axis=0)
+    if scale is None:
+        scale = X.std(axis=0)
+        scale[scale == 0] = 1
+    X = (X - center) / scale
+    return expand_to(get_expansion(X), degree)
+
+
+def get_expansion(X):
+    """Return the monomials of degree at most 1 in the columns of the array `X`, to be
+    extended to higher degrees by `expand_to`."""
+    num_cols = X.shape[1]
+    # Column-major blocks keep each monomial's values contiguous.
+    return {
+        "blocks": [np.ones((len(X), 1), order="F"), np.asfortranarray(X)],
+        "powers": [np.zeros((1, num_cols), dtype=int), np.eye(num_cols, dtype=int)],
+        "last": [np.zeros(1, dtype=int), np.arange(num_cols)],
+    }
+
+
+def expand_to(expansion, degree):
+    """Return the monomials of degree at most `degree` in `expansion`, together with the
+    exponent of each column in each, extending `expansion` in place as needed.
+
+    The monomials of each degree are the products of those of the degree below with one
+    more column, so sweeping degrees 1 to d costs a single expansion to degree d. They
+    are ordered as by sklearn's PolynomialFeatures, so that the monomials of a lower
+    degree are a prefix of those of a higher one.
+    """
+    blocks = expansion["blocks"]
+    powers = expansion["powers"]
+    last = expansion["last"]
+    X = blocks[1]
+    num_cols = X.shape[1]
+    while len(blocks) <= degree:
+        # Multiplying each monomial only by the columns from the last one it contains
+        # onwards yields every monomial of the next degree once, in sklearn's order.
+        widths = num_cols - last[-1]
+        block = np.empty((len(X), widths.sum()), order="F")
+        offsets = np.concatenate([[0], np.cumsum(widths)])
+        for idx, start in enumerate(last[-1]):
+            np.multiply(
+                blocks[-1][:, idx, np.newaxis],
+                X[:, start:],
+                out=block[:, offsets[idx] : offsets[idx + 1]],
+            )
+        parents = np.repeat(np.arange(len(widths)), widths)
+        cols = np.concatenate([np.arange(start, num_cols) for start in last[-1]])
+        blocks.append(block)
+        powers.append(powers[-1][parents] + powers[1][cols])
+        last.append(cols)
+
+    features = np.empty((len(X), sum(len(p) for p in powers[: degree + 1])), order="F")
+    offset = 0
+    for block in blocks[: degree + 1]:
+        features[:, offset : offset + block.shape[1]] = block
+        offset += block.shape[1]
+    return features, np.vstack(powers[: degree + 1])
+
+
+def get_feature_names(cols, powers):
+    """Return the name of each polynomial feature with the given `powers` of `cols`, in
+    the format of sklearn's PolynomialFeatures."""
+    names = []
+    for row in powers:
+        terms = [
+            col if power == 1 else f"{col}^{power}"
+            for col, power in zip(cols, row)
+            if power
+        ]
+        names.append(" ".join(terms) if terms else "1")
+    return names
+
+
+def predict_poly(X, Y, X_new, degrees):
+    """Fit a least-squares polynomial regression of each column of the array `Y` on the
+    columns of `X` for each of `degrees`, and evaluate them at the rows of `X_new`.
+
+    Return a dict mapping each degree to the predictions (one column per column of `Y`)
+    and the R^2 of each column of `Y`. `X` and `X_new` are standardized and expanded
+    once, to the highest of `degrees`, and every column of `Y` is fit by a single solve
+    per degree.
+    """
+    center = X.mean(axis=0)
+    scale = X.std(axis=0)
+    scale[scale == 0] = 1
+    features, powers = expand_to(get_expansion((X - center) / scale), max(degrees))
+    features_new, _ = expand_to(get_expansion((X_new - center) / scale), max(degrees))
+    Y_centered = Y - Y.mean(axis=0)
+
+    fits = dict()
+    for degree in degrees:
+        terms = powers.sum(axis=1) <= degree
+        coefs = np.linalg.lstsq(features[:, terms], Y, rcond=None)[0]
+        residuals = Y - features[:, terms] @ coefs
+        scores = 1 - (residuals**2).sum(axis=0) / (Y_centered**2).sum(axis=0)
+        fits[degree] = (features_new[:, terms] @ coefs, scores)
+    return fits
+
+
+@timer("fit:gram_system")
+def get_gram_system(df, cols, feature_to_predict, degree=1, scoring="r2", n_folds=5):
+    """Return the normal equations of a degree-`degree` polynomial regression of
+    `feature_to_predict` (a column or a list of columns) on all of `cols`.
+
+    Every column subset's design matrix is a subset of the columns of the full expansion,
+    so subsets can be scored from this system without touching the data again. The
+    expansion itself is kept as well, for the sub-systems too ill-conditioned to solve
+    from the Gram matrix (see `score_col_subset`).
+
+    `scoring` is "r2" for the in-sample R^2, "loo" for the leave-one-out (PRESS) R^2 or
+    "kfold" for the `n_folds`-fold cross-validated R^2.
+    """
+    assert scoring in ("r2", "loo", "kfold"), f"Unknown scoring {scoring!r}!"
+    cols = list(cols)
+    targets = (
+        [feature_to_predict]
+        if isinstance(feature_to_predict, str)
+        else list(feature_to_predict)
+    )
+    X, powers = expand_cols(df, cols, degree=degree)
+    Y = df[targets].to_numpy(dtype="float64")
+    Y = Y - Y.mean(axis=0)
+
+    system = {
+        "cols": cols,
+        "targets": targets,
+        "powers": powers,
+        "gram": X.T @ X,
+        "moment": X.T @ Y,
+        "tss": (Y * Y).sum(axis=0),
+        "scoring": scoring,
+        "design": X,
+        "response": Y,
+    }
+    if scoring == "kfold":
+        from sklearn.model_selection import KFold
+
+        system["folds"] = [
+            fold for _, fold in KFold(n_folds, shuffle=True, random_state=0).split(X)
+        ]
+    return system
+
+
+def get_gram_stats(df, cols, targets, degree=1):
+    """Return sums from which `get_gram_system_from_stats` recovers the degree-`degree`
+    normal equations of `targets` on `cols`, and to which rows can be added later with
+    `update_gram_stats`."""
+    cols = list(cols)
+    X = df[cols].to_numpy(dtype="float64")
+    scale = X.std(axis=0)
+    scale[scale == 0] = 1
+    stats = {
+        "cols": cols,
+        "targets": list(targets),
+        "degree": degree,
+        "center": X.mean(axis=0),
+        "scale": scale,
+        "count": 0,
+    }
+    return update_gram_stats(stats, df)
+
+
+def update_gram_stats(stats, df):
+    """Add the rows of `df` to the sums `stats` in place."""
+    X, powers = expand_cols(
+        df,
+        stats["cols"],
+        degree=stats["degree"],
+        center=stats["center"],
+        scale=stats["scale"],
+    )
+    Y = df[stats["targets"]].to_numpy(dtype="float64")
+    if not stats["count"]:
+        stats["powers"] = powers
+        stats["gram"] = np.zeros((X.shape[1], X.shape[1]))
+        stats["xty"] = np.zeros((X.shape[1], Y.shape[1]))
+        stats["y_sum"] = np.zeros(Y.shape[1])
+        stats["yty"] = np.zeros(Y.shape[1])
+    stats["count"] += len(X)
+    stats["gram"] += X.T @ X
+    stats["xty"] += X.T @ Y
+    stats["y_sum"] += Y.sum(axis=0)
+    stats["yty"] += (Y * Y).sum(axis=0)
+    return stats
+
+
+def get_gram_system_from_stats(stats):
+    """Return the system of `get_gram_system` (with in-sample scoring) described by `stats`."""
+    y_mean = stats["y_sum"] / stats["count"]
+    # The first feature is the constant 1, so the first row of the Gram matrix holds the
+    # sums of the features.
+    return {
+        "cols": stats["cols"],
+        "targets": stats["targets"],
+        "powers": stats["powers"],
+        "gram": stats["gram"],
+        "moment": stats["xty"] - np.outer(stats["gram"][0], y_mean),
+        "tss": stats["yty"] - stats["count"] * y_mean**2,
+        "scoring": "r2",
+    }
+
+
+def get_terms(cols, powers, col_subset):
+    """Return a mask of the polynomial features with the given `powers` of `cols` that
+    only involve the columns in `col_subset`."""
+    excluded = [idx for idx, col in enumerate(cols) if col not in col_subset]
+    return powers[:, excluded].sum(axis=1) == 0
+
+
+def _get_loo_residuals(X, Y, residuals, leverage):
+    """Return the leave-one-out residuals of the least-squares fit of `Y` on `X`, given its
+    `residuals` and the `leverage` of each row.
+
+    Each is the residual divided by 1 - leverage, except for rows that are the only
+    support of some direction of `X` (a leverage of 1 up to rounding), which are refit
+    without the row instead.
+    """
+    refit = leverage > 1 - 1e-6
+    residuals = residuals / np.where(refit, 1, 1 - leverage)[:, np.newaxis]
+    for idx in np.flatnonzero(refit):
+        train = np.ones(len(X), dtype=bool)
+        train[idx] = False
+        coefs = np.linalg.lstsq(X[train], Y[train], rcond=None)[0]
+        residuals[idx] = Y[idx] - X[idx] @ coefs
+    return residuals
+
+
+def _invert_gram(gram, max_condition=None):
+    """Return the pseudo-inverse of the Gram matrix `gram`, or None if its condition number
+    exceeds `max_condition` (if given)."""
+    eigvals, eigvecs = np.linalg.eigh(gram)
+    if max_condition is not None and eigvals[0] < eigvals[-1] / max_condition:
+        return None
+    # Directions below the rank tolerance are dropped, as by np.linalg.pinv.
+    keep = eigvals > eigvals[-1] * len(eigvals) * np.finfo(float).eps
+    return (eigvecs[:, keep] / eigvals[keep]) @ eigvecs[:, keep].T
+
+
+@timer("score_col_subset")
+def score_col_subset(system, col_subset, degree=None):
+    """Return the score of the regression on `col_subset` described by `system`, with one
+    entry per target, restricted to the monomials of degree at most `degree` if given.
+
+    Normal equations whose condition number exceeds `max_condition`, as those of
+    higher-degree expansions of correlated columns do, are solved from the design matrix
+    of `system` instead when it has one.
+    """
+    terms = get_terms(system["cols"], system["powers"], col_subset)
+    if degree is not None:
+        terms &= system["powers"].sum(axis=1) <= degree
+    gram = system["gram"][np.ix_(terms, terms)]
+    moment = system["moment"][terms]
+    # Without a design matrix, the normal equations are all there is to solve.
+    limit = max_condition if "design" in system else None
+
+    if system["scoring"] == "kfold":
+        X = system["design"][:, terms]
+        Y = system["response"]
+        # Each fold's fit downdates the full normal equations by the fold's rows.
+        residuals = np.empty_like(Y)
+        for fold in system["folds"]:
+            X_fold = X[fold]
+            gram_inv = _invert_gram(gram - X_fold.T @ X_fold, limit)
+            if gram_inv is None:
+                train = np.ones(len(X), dtype=bool)
+                train[fold] = False
+                coefs = np.linalg.lstsq(X[train], Y[train], rcond=None)[0]
+            else:
+                coefs = gram_inv @ (moment - X_fold.T @ Y[fold])
+            residuals[fold] = Y[fold] - X_fold @ coefs
+        return 1 - (residuals**2).sum(axis=0) / system["tss"]
+
+    # One factorization of the sub-system serves every target.
+    gram_inv = _invert_gram(gram, limit)
+    if gram_inv is None:
+        X = system["design"][:, terms]
+        U, singular_values, _ = np.linalg.svd(X, full_matrices=False)
+        U = U[
+            :, singular_values > singular_values[0] * max(X.shape) * np.finfo(float).eps
+        ]
+        # U spans the columns of X, so U U^T is the hat matrix.
+        Y = system["response"]
+        residuals = Y - U @ (U.T @ Y)
+        if system["scoring"] == "loo":
+            residuals = _get_loo_residuals(X, Y, residuals, (U * U).sum(axis=1))
+        return 1 - (residuals**2).sum(axis=0) / system["tss"]
+
+    if system["scoring"] == "r2":
+        coefs = gram_inv @ moment
+        return (coefs * moment).sum(axis=0) / system["tss"]
+
+    # The leverages are the diagonal of the hat matrix X (X^T X)^+ X^T.
+    X = system["design"][:, terms]
+    Y = system["response"]
+    leverage = np.einsum("ij,jk,ik->i", X, gram_inv, X)
+    residuals = _get_loo_residuals(X, Y, Y - X @ (gram_inv @ moment), leverage)
+    return 1 - (residuals**2).sum(axis=0) / system["tss"]
+
+
+def _score_chunk(system, col_subsets):
+    return [score_col_subset(system, col_subset) for col_subset in col_subsets]
+
+
+def score_col_subsets(
+    system, col_subsets, executor="serial", n_workers=None, chunk_size=64
+):
+    """Return the scores of each of `col_subsets` under `system`, in order.
+
+    `executor` is one of "serial", "threads" or "processes". The subsets are split into
+    chunks of `chunk_size` that are scored by `n_workers` workers with
+    `parallel.map_shared`, so worker processes receive `system` only once.
+    """
+    if executor == "serial":
+        return _score_chunk(system, col_subsets)
+
+    chunks = [
+        col_subsets[idx : idx + chunk_size]
+        for idx in range(0, len(col_subsets), chunk_size)
+    ]
+    results = map_shared(
+        _score_chunk, system, chunks, executor=executor, n_workers=n_workers
+    )
+    return [score for chunk in results for score in chunk]
+
+
+def get_col_subset_score_table(
+    df,
+    cols,
+    targets,
+    num_cols,
+    degree=1,
+    executor="serial",
+    n_workers=None,
+    scoring="r2",
+    n_folds=5,
+):
+    """Return a pd.DataFrame with the score of each size-`num_cols` subset of `cols`
+    (rows, in the order given by `combinations`) for predicting each of `targets` (columns).
+    """
+    system = get_gram_system(
+        df, cols, targets, degree=degree, scoring=scoring, n_folds=n_folds
+    )
+    col_subsets = list(combinations(cols, num_cols))
+    scores = score_col_subsets(
+        system, col_subsets, executor=executor, n_workers=n_workers
+    )
+    return pd.DataFrame(
+        scores,
+        index=pd.Index(col_subsets, tupleize_cols=False),
+        columns=system["targets"],
+    )
+
+
+def get_col_subset_scores(
+    df,
+    cols,
+    feature_to_predict,
+    num_cols,
+    degree=1,
+    executor="serial",
+    n_workers=None,
+    scoring="r2",
+    n_folds=5,
+):
+    """Return a dict mapping each size-`num_cols` subset of `cols` to its score for
+    predicting `feature_to_predict`, in the order given by `combinations`."""
+    table = get_col_subset_score_table(
+        df,
+        cols,
+        [feature_to_predict],
+        num_cols,
+        degree=degree,
+        executor=executor,
+        n_workers=n_workers,
+        scoring=scoring,
+        n_folds=n_folds,
+    )
+    return table[feature_to_predict].to_dict()
+
+
+@timer("fit:targets")
+def fit_targets(df, cols, targets, degree=1, scoring="r2", n_folds=5):
+    """Fit a degree-`degree` regression of each of `targets` on `cols` with a single
+    least-squares solve.
+
+    Return a pd.Series of scores (see `get_gram_system` for `scoring`) and a pd.DataFrame
+    of coefficients (one column per target) with respect to the polynomial features of
+    the standardized `cols`.
+    """
+    cols = list(cols)
+    targets = list(targets)
+    X, powers = expand_cols(df, cols, degree=degree)
+    Y = df[targets].to_numpy(dtype="float64")
+    Y_centered = Y - Y.mean(axis=0)
+
+    coefs = np.linalg.lstsq(X, Y, rcond=None)[0]
+    residuals = Y - X @ coefs
+    if scoring == "r2":
+        scores = 1 - (residuals**2).sum(axis=0) / (Y_centered**2).sum(axis=0)
+    else:
+        system = get_gram_system(
+            df, cols, targets, degree=degree, scoring=scoring, n_folds=n_folds
+        )
+        scores = score_col_subset(system, cols)
+
+    return (
+        pd.Series(scores, index=targets),
+        pd.DataFrame(coefs, index=get_feature_names(cols, powers), columns=targets),
+    )
+
+
+def get_degree_scores(df, cols, targets, degrees=(1, 2, 3, 4), scoring="r2", n_folds=5):
+    """Return a pd.DataFrame with the score (see `get_gram_system` for `scoring`) of the
+    regression of each of `targets` (columns) on all of `cols` for each of `degrees`
+    (rows).
+
+    The system of the highest degree contains those of the lower ones, so a single
+    expansion and Gram matrix serve every degree.
+    """
+    system = get_gram_system(
+        df, cols, targets, degree=max(degrees), scoring=scoring, n_folds=n_folds
+    )
+    return pd.DataFrame(
+        [score_col_subset(system, cols, degree=degree) for degree in degrees],
+        index=list(degrees),
+        columns=list(targets),
+    )
+
+
+def _bootstrap_batch(bootstrap, seed_seq, num_replicates):
+    """Return the R^2 (replicates x targets) and coefficients (replicates x terms x
+    targets) of each column subset of `bootstrap` on `num_replicates` resamples drawn
+    with the generator seeded by `seed_seq`.
+
+    Each resample is a vector of multinomial weights on the discs, so every replicate's
+    normal equations are weighted sums over the same design, computed for all replicates
+    of the batch at once and shared by the column subsets.
+    """
+    X = bootstrap["design"]
+    Y = bootstrap["response"]
+    rng = np.random.default_rng(seed_seq)
+    weights = rng.multinomial(len(X), np.full(len(X), 1 / len(X)), size=num_replicates)
+    weights = weights.astype("float64")
+
+    gram = np.swapaxes(weights[:, :, np.newaxis] * X, 1, 2) @ X
+    moment = np.swapaxes(weights[:, :, np.newaxis] * X, 1, 2) @ Y
+    y_sum = weights @ Y
+    tss = weights @ (Y * Y) - y_sum**2 / len(X)
+
+    results = []
+    for terms in bootstrap["terms"]:
+        gram_subset = gram[:, terms][:, :, terms]
+        moment_subset = moment[:, terms]
+        coefs = np.linalg.pinv(gram_subset, hermitian=True) @ moment_subset
+        # The weighted residual sum of squares is y^T W y - b^T X^T W y at the solution.
+        rss = weights @ (Y * Y) - (coefs * moment_subset).sum(axis=1)
+        results.append((1 - rss / tss, coefs))
+    return results
+
+
+def bootstrap_col_subsets(
+    df,
+    cols,
+    targets,
+    col_subsets=None,
+    degree=1,
+    n_replicates=1000,
+    confidence=0.95,
+    seed=0,
+    batch_size=100,
+    executor="serial",
+    n_workers=None,
+):
+    """Return bootstrap confidence intervals of the R^2 and coefficients of the
+    degree-`degree` regressions of each of `targets` on each of `col_subsets` (by
+    default, all of `cols` at once).
+
+    The `n_replicates` resamples are split into batches of `batch_size`, each drawn from
+    its own child of `np.random.SeedSequence(seed)`, so the results depend only on `seed`
+    and not on the `executor` ("serial", "threads" or "processes") or the `n_workers`
+    solving the batches. The intervals are the percentile intervals at `confidence`.
+    Each replicate's R^2 is in-sample on its resample, so for regressions with nearly as
+    many features as discs the interval can lie above the estimate.
+
+    Return a pd.DataFrame of scores indexed by (col_subset, target) and a pd.DataFrame
+    of coefficients indexed by (col_subset, target, feature), each with the estimate on
+    all discs ("estimate") and the bounds of its interval ("low" and "high").
+    """
+    cols = list(cols)
+    targets = list(targets)
+    col_subsets = (
+        [tuple(cols)] if col_subsets is None else list(map(tuple, col_subsets))
+    )
+    X, powers = expand_cols(df, cols, degree=degree)
+    Y = df[targets].to_numpy(dtype="float64")
+    terms = [np.flatnonzero(get_terms(cols, powers, subset)) for subset in col_subsets]
+    bootstrap = {"design": X, "response": Y, "terms": terms}
+
+    seed_seqs, sizes = get_seeded_batches(n_replicates, batch_size, seed)
+    # The batched products and solves release the GIL, so threads work as well.
+    results = map_shared(
+        _bootstrap_batch,
+        bootstrap,
+        seed_seqs,
+        sizes,
+        executor=executor,
+        n_workers=n_workers,
+    )
+
+    quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+    feature_names = np.array(get_feature_names(cols, powers))
+    Y_centered = Y - Y.mean(axis=0)
+    scores = []
+    coefs = []
+    for idx, (subset, subset_terms) in enumerate(zip(col_subsets, terms)):
+        replicate_scores = np.concatenate([batch[idx][0] for batch in results])
+        replicate_coefs = np.concatenate([batch[idx][1] for batch in results])
+        score_bounds = np.quantile(replicate_scores, quantiles, axis=0)
+        coef_bounds = np.quantile(replicate_coefs, quantiles, axis=0)
+
+        X_subset = X[:, subset_terms]
+        estimate = np.linalg.lstsq(X_subset, Y, rcond=None)[0]
+        residuals = Y - X_subset @ estimate
+        score = 1 - (residuals**2).sum(axis=0) / (Y_centered**2).sum(axis=0)
+        for target_idx, target in enumerate(targets):
+            scores.append(
+                (subset, target, score[target_idx], *score_bounds[:, target_idx])
+            )
+            for term_idx, feature in enumerate(feature_names[subset_terms]):
+                coefs.append(
+                    (
+                        subset,
+                        target,
+                        feature,
+                        estimate[term_idx, target_idx],
+                        *coef_bounds[:, term_idx, target_idx],
+                    )
+                )
+
+    return (
+        pd.DataFrame(
+            scores, columns=["col_subset", "target", "estimate", "low", "high"]
+        ).set_index(["col_subset", "target"]),
+        pd.DataFrame(
+            coefs,
+            columns=["col_subset", "target", "feature", "estimate", "low", "high"],
+        ).set_index(["col_subset", "target", "feature"]),
+    )
+
+
+def _get_path_coefs(X, Y, alphas, penalty, l1_ratio, tol, max_iter):
+    """Return the (len(alphas), 1 + p, t) coefficients, intercepts first, of the regression
+    of `Y` on the p columns of `X` penalized by `penalty` with each of `alphas`.
+
+    Both penalties work from the centered Gram matrix and moments: "ridge" solves every
+    alpha at once from a single eigendecomposition, and "elasticnet" runs coordinate
+    descent over the decreasing `alphas`, each starting from the previous solution.
+    """
+    x_mean = X.mean(axis=0)
+    y_mean = Y.mean(axis=0)
+    X = X - x_mean
+    Y = Y - y_mean
+    gram = X.T @ X
+    moment = X.T @ Y
+
+    if penalty == "ridge":
+        eigvals, eigvecs = np.linalg.eigh(gram)
+        rotated = eigvecs.T @ moment
+        coefs = eigvecs @ (rotated / (eigvals[:, None] + alphas[:, None, None]))
+    else:
+        from sklearn.linear_model import enet_path
+
+        X = np.asfortranarray(X)
+        coefs = np.empty((len(alphas), X.shape[1], Y.shape[1]))
+        for idx in range(Y.shape[1]):
+            _, path, _ = enet_path(
+                X,
+                Y[:, idx],
+                l1_ratio=l1_ratio,
+                alphas=alphas,
+                precompute=gram,
+                Xy=moment[:, idx],
+                tol=tol,
+                max_iter=max_iter,
+            )
+            coefs[:, :, idx] = path.T
+
+    intercepts = y_mean - np.einsum("p,apt->at", x_mean, coefs)
+    return np.concatenate([intercepts[:, None, :], coefs], axis=1)
+
+
+def get_regularization_path(
+    df,
+    cols,
+    targets,
+    degree=1,
+    penalty="ridge",
+    alphas=None,
+    l1_ratio=0.5,
+    n_alphas=50,
+    eps=1e-3,
+    n_folds=5,
+    tol=1e-6,
+    max_iter=10000,
+):
+    """Fit a penalized degree-`degree` regression of each of `targets` on `cols` for each
+    of `alphas`, and choose the best alpha of each target by `n_folds`-fold
+    cross-validation.
+
+    `penalty` is "ridge", "lasso" or "elasticnet" (mixing the two with `l1_ratio`), with
+    the objectives of sklearn's Ridge, Lasso and ElasticNet on the polynomial features of
+    the standardized `cols`; the intercept isn't penalized. By default `alphas` are
+    `n_alphas` values spaced evenly on a log scale, decreasing from the largest useful
+    one to `eps` times it. `tol` and `max_iter` bound the coordinate descent of the lasso
+    and elastic net, as in sklearn.
+
+    Return a dict with the alphas, the coefficient path (alphas x features x targets,
+    indexed like the `powers` of `expand_cols`), the cross-validated mean squared error
+    of each alpha and target, and the best alpha and its coefficients for each target.
+    """
+    assert penalty in ("ridge", "lasso", "elasticnet"), f"Unknown penalty {penalty!r}!"
+    if penalty == "lasso":
+        l1_ratio = 1.0
+    cols = list(cols)
+    targets = list(targets)
+    X, powers = expand_cols(df, cols, degree=degree)
+    X = X[:, 1:]  # The intercept is fit separately.
+    Y = df[targets].to_numpy(dtype="float64")
+
+    if alphas is None:
+        X_centered = X - X.mean(axis=0)
+        if penalty == "ridge":
+            # Beyond the largest eigenvalue of the Gram matrix, every coefficient shrinks.
+            alpha_max = np.linalg.eigvalsh(X_centered.T @ X_centered)[-1]
+        else:
+            # The smallest alpha at which every coefficient of every target is zero.
+            moment = X_centered.T @ (Y - Y.mean(axis=0))
+            alpha_max = np.abs(moment).max() / (len(X) * l1_ratio)
+        alphas = np.geomspace(alpha_max, alpha_max * eps, n_alphas)
+    alphas = np.sort(np.asarray(alphas, dtype="float64"))[::-1]
+
+    from sklearn.model_selection import KFold
+
+    errors = np.zeros((len(alphas), len(targets)))
+    for train, test in KFold(n_folds, shuffle=True, random_state=0).split(X):
+        coefs = _get_path_coefs(
+            X[train], Y[train], alphas, penalty, l1_ratio, tol, max_iter
+        )
+        predictions = coefs[:, 0, None, :] + np.einsum(
+            "np,apt->ant", X[test], coefs[:, 1:]
+        )
+        errors += ((predictions - Y[test]) ** 2).sum(axis=1)
+    errors /= len(X)
+
+    coefs = _get_path_coefs(X, Y, alphas, penalty, l1_ratio, tol, max_iter)
+    best = errors.argmin(axis=0)
+
+    return {
+        "cols": cols,
+        "targets": targets,
+        "penalty": penalty,
+        "l1_ratio": l1_ratio,
+        "powers": powers,
+        "alphas": alphas,
+        "coefs": coefs,
+        "cv_mse": pd.DataFrame(errors, index=alphas, columns=targets),
+        "best_alpha": pd.Series(alphas[best], index=targets),
+        "best_coefs": pd.DataFrame(
+            coefs[best, :, np.arange(len(targets))].T,
+            index=get_feature_names(cols, powers),
+            columns=targets,
+        ),
+    }
+
+
+def get_col_subsets(
+    df,
+    cols,
+    feature_to_predict,
+    num_cols,
+    threshold,
+    degree=1,
+    executor="serial",
+    n_workers=None,
+    scoring="r2",
+    n_folds=5,
+):
     """Return the list of column subsets of size `num_cols` whose score for predicting
     `feature_to_predict` exceed `threshold`."""
 
-    col_subsets = []
+    scores = get_col_subset_scores(
+        df,
+        cols,
+        feature_to_predict,
+        num_cols,
+        degree=degree,
+        executor=executor,
+        n_workers=n_workers,
+        scoring=scoring,
+        n_folds=n_folds,
+    )
+    return threshold_col_subsets(scores, threshold)
 
-    for col_subset in combinations(cols, num_cols):
-        col_subset = list(col_subset)
-        df_reduced = df[col_subset]
-        model = make_pipeline(PolynomialFeatures(degree), LinearRegression())
-        model.fit(df_reduced, df[feature_to_predict])
-        score = model.score(df_reduced, df[feature_to_predict])
 
-        if score > threshold:
-            col_subsets.append(col_subset)
+def get_best_col_subset(
+    df,
+    cols,
+    feature_to_predict,
+    num_cols,
+    degree=1,
+    executor="serial",
+    n_workers=None,
+    scoring="r2",
+    n_folds=5,
+):
+    """Return the best size-`num_cols` subset of columns for predicting `feature_to_predict`."""
 
-    return col_subsets
+    scores = get_col_subset_scores(
+        df,
+        cols,
+        feature_to_predict,
+        num_cols,
+        degree=degree,
+        executor=executor,
+        n_workers=n_workers,
+        scoring=scoring,
+        n_folds=n_folds,
+    )
+    return best_col_subset(scores)
 
 
-def get_best_col_subset(df, cols, feature_to_predict, num_cols, degree=1):
-    """Return the best size-`num_cols` subset of columns for predicting `feature_to_predict`."""
+def threshold_col_subsets(scores, threshold):
+    """Return the column subsets in `scores` whose score exceeds `threshold`."""
+    return [
+        list(col_subset) for col_subset, score in scores.items() if score > threshold
+    ]
 
-    best_score = None
-    for col_subset in combinations(cols, num_cols):
-        col_subset = list(col_subset)
-        df_reduced = df[col_subset]
-        model = make_pipeline(PolynomialFeatures(degree), LinearRegression())
-        model.fit(df_reduced, df[feature_to_predict])
-        score = model.score(df_reduced, df[feature_to_predict])
 
+def best_col_subset(scores):
+    """Return the first column subset in `scores` with the highest score."""
+    best_score = None
+    for col_subset, score in scores.items():
         if best_score is None or score > best_score:
             best_score = score
             best_col_subset = col_subset
 
-    return best_col_subset
+    return list(best_col_subset)
+
+
+def get_top_col_subsets(
+    feature_to_predict,
+    degree,
+    num_cols,
+    top=5,
+    executor="serial",
+    n_workers=None,
+    scoring="r2",
+    n_folds=5,
+):
+    """Return the `top` highest-scoring size-`num_cols` subsets for predicting `feature_to_predict`."""
+    df = get_df_innova()
+    scores = get_col_subset_scores(
+        df,
+        cols_quantitative,
+        feature_to_predict,
+        num_cols,
+        degree=degree,
+        executor=executor,
+        n_workers=n_workers,
+        scoring=scoring,
+        n_folds=n_folds,
+    )
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top]
+
 
+def get_2d_path(feature_to_predict, degree, cols):
+    [x1, x2] = cols
+    return f"Figures/2d/degree-{degree}-{feature_to_predict}-{x1}-vs-{x2}.png"
+
+
+@timer("fit:surfaces")
+def get_surfaces(df, plots):
+    """Fit the regressions plotted by `make_2d_plot` for each (cols, degree,
+    feature_to_predict) in `plots` and evaluate them on the plot's grid.
+
+    Each pair of columns is expanded once, for the discs and for its grid, to the highest
+    degree requested of it, and all of its degrees and flight numbers are fit and
+    evaluated together. Return a dict mapping each of `plots` to a dict with the 50 x 50
+    predictions ("values"), their "extent" and the R^2 ("score") of the regression.
+    """
+    requests = dict()
+    for cols, degree, feature_to_predict in plots:
+        degrees, targets = requests.setdefault(tuple(cols), (set(), []))
+        degrees.add(degree)
+        if feature_to_predict not in targets:
+            targets.append(feature_to_predict)
+
+    surfaces = dict()
+    for cols, (degrees, targets) in requests.items():
+        # Compute canvas bounds
+        # We manually add a constant 10% margin as these are used to plot our colors.
+        [x1, x2] = cols
+        x1_min = min(df[x1])
+        x1_max = max(df[x1])
+        x1_margin = (x1_max - x1_min) * 0.1
+        x1_min -= x1_margin
+        x1_max += x1_margin
+
+        x2_min = min(df[x2])
+        x2_max = max(df[x2])
+        x2_margin = (x2_max - x2_min) * 0.1
+        x2_min -= x2_margin
+        x2_max += x2_margin
+
+        grid_points = (
+            np.mgrid[x1_min:x1_max:50j, x2_min:x2_max:50j].reshape(2, -1).T
+        )  # `grid_points` is a length-2500 list of ordered pairs
+        fits = predict_poly(
+            df[list(cols)].to_numpy(dtype="float64"),
+            df[targets].to_numpy(dtype="float64"),
+            grid_points,
+            sorted(degrees),
+        )
+        for degree, (predictions, scores) in fits.items():
+            for idx, feature_to_predict in enumerate(targets):
+                surfaces[cols, degree, feature_to_predict] = {
+                    "values": predictions[:, idx].reshape(50, 50).T,
+                    "extent": [x1_min, x1_max, x2_min, x2_max],
+                    "score": scores[idx],
+                }
+    return {
+        (tuple(cols), degree, feature_to_predict): surfaces[
+            tuple(cols), degree, feature_to_predict
+        ]
+        for cols, degree, feature_to_predict in plots
+    }
 
-def make_2d_plot(df, feature_to_predict, degree, cols):
 
-    # Fit model, get score
-    model = make_pipeline(PolynomialFeatures(degree), LinearRegression())
-    model.fit(df[cols], df[feature_to_predict])
-    score = model.score(df[cols], df[feature_to_predict])
+def make_2d_plot(df, feature_to_predict, degree, cols, surface=None):
+    """Plot the degree-`degree` regression of `feature_to_predict` on the pair `cols`,
+    using `surface` (from `get_surfaces`) if it was already computed."""
+    import matplotlib.pyplot as pp
 
-    # Compute canvas bounds
-    # We manually add a constant 10% margin as these are used to plot our colors.
+    # Fit model, get score and predictions
+    if surface is None:
+        [surface] = get_surfaces(
+            df, [(tuple(cols), degree, feature_to_predict)]
+        ).values()
     [x1, x2] = cols
-    x1_min = min(df[x1])
-    x1_max = max(df[x1])
-    x1_margin = (x1_max - x1_min) * 0.1
-    x1_min -= x1_margin
-    x1_max += x1_margin
-
-    x2_min = min(df[x2])
-    x2_max = max(df[x2])
-    x2_margin = (x2_max - x2_min) * 0.1
-    x2_min -= x2_margin
-    x2_max += x2_margin
-
-    # Make predictions
-    grid_points = (
-        np.mgrid[x1_min:x1_max:50j, x2_min:x2_max:50j].reshape(2, -1).T
-    )  # `grid_points` is a length-2500 list of ordered pairs
-    Y = model.predict(grid_points).reshape(50, 50).T
+    Y = surface["values"]
+    score = surface["score"]
+    x1_min, x1_max, x2_min, x2_max = surface["extent"]
 
     # Set up colormap keyword args
     y_min, y_max = features[feature_to_predict]
@@ -128,7 +930,9 @@ def make_2d_plot(df, feature_to_predict, degree, cols):
     cb.set_label(feature_to_predict.capitalize())
 
     # Save and close figure
-    pp.savefig(f"Figures/2d/degree-{degree}-{feature_to_predict}-{x1}-vs-{x2}.png")
+    path = get_2d_path(feature_to_predict, degree, cols)
+    with timed("savefig", path=path):
+        pp.savefig(path)
     pp.close()
 
 
@@ -136,42 +940,44 @@ def analyze_2d(feature_to_predict, degree, threshold=0.9):
     df = get_df_innova()
 
     num_cols = 2
-    col_pairs = get_col_subsets(
-        df,
-        cols_quantitative,
-        feature_to_predict,
-        num_cols=num_cols,
-        threshold=threshold,
-        degree=degree,
+    scores = get_col_subset_scores(
+        df, cols_quantitative, feature_to_predict, num_cols=num_cols, degree=degree
     )
+    col_pairs = threshold_col_subsets(scores, threshold)
     if not col_pairs:
         # No pair of columns achieved a score above the threshold
-        col_pairs = [
-            get_best_col_subset(
-                df,
-                cols_quantitative,
-                feature_to_predict,
-                num_cols=num_cols,
-                degree=degree,
-            )
-        ]
+        col_pairs = [best_col_subset(scores)]
 
-    for cols_good in col_pairs:
-        make_2d_plot(df, feature_to_predict, degree, cols_good)
+    plots = [(cols_good, degree, feature_to_predict) for cols_good in col_pairs]
+    jobs = [
+        plot_job(make_2d_plot, df, feature_to_predict, degree, cols, surface=surface)
+        for (cols, degree, feature_to_predict), surface in get_surfaces(
+            df, plots
+        ).items()
+    ]
+    render_jobs(jobs, n_workers=1)
 
 
-def make_1d_plot(df, feature_to_predict, degree, col):
+def get_1d_path(feature_to_predict, degree, col):
+    return f"Figures/1d/degree-{degree}-{feature_to_predict}-{col}.png"
 
-    # Fit model; get score
-    model = make_pipeline(PolynomialFeatures(degree=degree), LinearRegression())
-    model.fit(df[[col]], df[feature_to_predict])
-    score = model.score(df[[col]], df[feature_to_predict])
 
-    # Make predictions
+def make_1d_plot(df, feature_to_predict, degree, col):
+    import matplotlib.pyplot as pp
+    from matplotlib import ticker
+
+    # Fit model; get score and predictions
     x_min = min(df[col])
     x_max = max(df[col])
     x_plot = np.linspace(x_min, x_max, 50)
-    Y = model.predict(x_plot[:, np.newaxis])
+    with timed("fit:1d_plot"):
+        [(Y, [score])] = predict_poly(
+            df[[col]].to_numpy(dtype="float64"),
+            df[[feature_to_predict]].to_numpy(dtype="float64"),
+            x_plot[:, np.newaxis],
+            [degree],
+        ).values()
+    Y = Y[:, 0]
 
     # Compute y-margins
     y_min, y_max = features[feature_to_predict]
@@ -209,7 +1015,9 @@ def make_1d_plot(df, feature_to_predict, degree, col):
     ax.plot(x_plot, Y)
 
     # Save figure
-    pp.savefig(f"Figures/1d/degree-{degree}-{feature_to_predict}-{col}.png")
+    path = get_1d_path(feature_to_predict, degree, col)
+    with timed("savefig", path=path):
+        pp.savefig(path)
     pp.close()
 
 
@@ -218,43 +1026,142 @@ def analyze_1d(feature_to_predict, degree, threshold=0.9):
     df = get_df_innova()
 
     num_cols = 1
-    cols_best = get_col_subsets(
+    scores = get_col_subset_scores(
+        df, cols_quantitative, feature_to_predict, num_cols=num_cols, degree=degree
+    )
+    cols_best = threshold_col_subsets(scores, threshold)
+    if not cols_best:
+        # No column achieved a score above the threshold
+        cols_best = [best_col_subset(scores)]
+
+    jobs = [
+        plot_job(make_1d_plot, df, feature_to_predict, degree, col)
+        for [col] in cols_best
+    ]
+    render_jobs(jobs, n_workers=1)
+
+
+def plot_job(make_plot, df, feature_to_predict, degree, cols, **kwargs):
+    """Return the figure spec of `make_plot` (`make_1d_plot` with a single column or
+    `make_2d_plot` with a pair), rendered in the regression `style`."""
+    if make_plot is make_1d_plot:
+        path = get_1d_path(feature_to_predict, degree, cols)
+    else:
+        path = get_2d_path(feature_to_predict, degree, cols)
+    job = make_job(make_plot, path, df, feature_to_predict, degree, cols, **kwargs)
+    # The plots only depend on `df`, which is hashed with the rest of their arguments.
+    job["sources"] = []
+    job["style"] = style
+    return job
+
+
+def analyze(feature_to_predict, degree, scoring="r2"):
+    df = get_df_innova()
+    scores, _ = fit_targets(
+        df, cols_quantitative, [feature_to_predict], degree=degree, scoring=scoring
+    )
+    return scores[feature_to_predict]
+
+
+def analyze_bootstrap(degree, n_replicates=1000, confidence=0.95, seed=0):
+    """Print the score of a degree-`degree` regression on all columns for each flight
+    number together with its bootstrap confidence interval."""
+    df = get_df_innova()
+    targets = [feature for feature in features if feature in df]
+    scores, coefs = bootstrap_col_subsets(
         df,
         cols_quantitative,
-        feature_to_predict,
-        num_cols=num_cols,
-        threshold=threshold,
+        targets,
         degree=degree,
+        n_replicates=n_replicates,
+        confidence=confidence,
+        seed=seed,
     )
-    if not cols_best:
-        # No column achieved a score above the threshold
-        cols_best = [
-            get_best_col_subset(
-                df,
-                cols_quantitative,
-                feature_to_predict,
-                num_cols=num_cols,
-                degree=degree,
-            )
-        ]
+    for (_, target), (score, low, high) in scores.iterrows():
+        print(f"Predicting {target} with a degree-{degree} regression.")
+        print(f"Score = {score} ({confidence:.0%} CI {low} to {high})")
+    return scores, coefs
+
+
+def analyze_regularization(degree, penalty="ridge", n_folds=5):
+    """Print the best alpha of a penalized degree-`degree` regression on all columns for
+    each flight number, together with its `n_folds`-fold cross-validated R^2."""
+    df = get_df_innova()
+    targets = [feature for feature in features if feature in df]
+    path = get_regularization_path(
+        df, cols_quantitative, targets, degree=degree, penalty=penalty, n_folds=n_folds
+    )
+    for target in targets:
+        score = 1 - path["cv_mse"][target].min() / df[target].var(ddof=0)
+        print(f"Predicting {target} with a degree-{degree} {penalty} regression.")
+        print(f"Alpha = {path['best_alpha'][target]}, score = {score}")
+    return path
 
-    for [col] in cols_best:
-        make_1d_plot(df, feature_to_predict, degree, col)
 
+def analyze_all(
+    degree,
+    threshold=0.9,
+    executor="serial",
+    n_workers=None,
+    scoring="r2",
+    render_workers=None,
+):
+    """Print the score of a degree-`degree` regression on all columns for each flight number
+    and plot the best one- and two-column regressions, solving all flight numbers at once.
 
-def analyze(feature_to_predict, degree):
+    Figures are rendered by `render_workers` processes, skipping those whose inputs are
+    unchanged since they were last rendered.
+    """
     df = get_df_innova()
-    model = make_pipeline(PolynomialFeatures(degree=degree), LinearRegression())
-    model.fit(df[cols_quantitative], df[feature_to_predict])
-    return model.score(df[cols_quantitative], df[feature_to_predict])
+    targets = [feature for feature in features if feature in df]
+
+    scores, _ = fit_targets(
+        df, cols_quantitative, targets, degree=degree, scoring=scoring
+    )
+    for feature_to_predict in targets:
+        print(f"Predicting {feature_to_predict} with a degree-{degree} regression.")
+        print(f"Score = {scores[feature_to_predict]}")
+
+    jobs = []
+    plots = []
+    for num_cols in [1, 2]:
+        table = get_col_subset_score_table(
+            df,
+            cols_quantitative,
+            targets,
+            num_cols=num_cols,
+            degree=degree,
+            executor=executor,
+            n_workers=n_workers,
+            scoring=scoring,
+        )
+        for feature_to_predict in targets:
+            subset_scores = table[feature_to_predict].to_dict()
+            col_subsets = threshold_col_subsets(subset_scores, threshold)
+            if not col_subsets:
+                col_subsets = [best_col_subset(subset_scores)]
+
+            for cols_good in col_subsets:
+                if num_cols == 1:
+                    [col] = cols_good
+                    jobs.append(
+                        plot_job(make_1d_plot, df, feature_to_predict, degree, col)
+                    )
+                else:
+                    plots.append((cols_good, degree, feature_to_predict))
+
+    # Every 2D plot's surface is computed in one batch rather than by each job.
+    for (cols, degree, feature_to_predict), surface in get_surfaces(df, plots).items():
+        jobs.append(
+            plot_job(
+                make_2d_plot, df, feature_to_predict, degree, cols, surface=surface
+            )
+        )
+    render_jobs(jobs, n_workers=render_workers)
 
 
 if __name__ == "__main__":
 
     threshold = 0.9
     for degree in [1, 2]:
-        for feature_to_predict in features:
-            print(f"Predicting {feature_to_predict} with a degree-{degree} regression.")
-            print(f"Score = {analyze(feature_to_predict, degree=degree)}")
-            analyze_1d(feature_to_predict, degree=degree, threshold=threshold)
-            analyze_2d(feature_to_predict, degree=degree, threshold=threshold)
+        analyze_all(degree, threshold=threshold)
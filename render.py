@@ -0,0 +1,182 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+manifest_path = os.path.join(".cache", "render.json")
+
+# Data files read by the plotting functions, whose contents every figure depends on.
+sources = ["pdga.csv", "innova.csv"]
+
+# rcParams that change how a figure looks.
+style_params = ["text.usetex", "font.family", "font.size", "figure.dpi", "savefig.dpi"]
+
+
+def make_job(func, path, *args, **kwargs):
+    """Return a figure spec for `func(*args, **kwargs)`, which saves a figure to `path`.
+
+    The figure is assumed to depend on the files in `sources`; set the spec's "sources" to
+    an empty list if all of the data it plots is passed in `args` or `kwargs`. Set its
+    "style" to a dict of rcParams to render it with those in effect.
+    """
+    return {"func": func, "path": path, "args": args, "kwargs": kwargs}
+
+
+def _fingerprint(obj, h):
+    if isinstance(obj, pd.DataFrame):
+        h.update(repr(list(obj.columns)).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    elif isinstance(obj, pd.Series):
+        h.update(repr(obj.name).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            _fingerprint(key, h)
+            _fingerprint(value, h)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _fingerprint(value, h)
+    elif hasattr(obj, "get_params"):
+        # sklearn estimators
+        h.update(type(obj).__qualname__.encode())
+        h.update(repr(sorted(obj.get_params().items())).encode())
+    else:
+        h.update(pickle.dumps(obj))
+
+
+def fingerprint(*objs):
+    """Return a hash of the contents of `objs` (DataFrames, estimators and plain values)."""
+    h = hashlib.sha256()
+    for obj in objs:
+        _fingerprint(obj, h)
+    return h.hexdigest()
+
+
+def job_hash(job):
+    """Return a hash of everything the figure produced by `job` depends on: the data
+    files, the plotting code, its arguments and the plot style."""
+    h = hashlib.sha256()
+    for source in job.get("sources", sources):
+        stat = os.stat(source)
+        h.update(f"{source}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+
+    func = job["func"]
+    h.update(f"{func.__module__}.{func.__qualname__}".encode())
+    h.update(inspect.getsource(func).encode())
+    _fingerprint(job["args"], h)
+    _fingerprint(job["kwargs"], h)
+
+    import matplotlib
+
+    style = {param: matplotlib.rcParams[param] for param in style_params}
+    style.update(job.get("style", dict()))
+    _fingerprint(style, h)
+    return h.hexdigest()
+
+
+def load_manifest():
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def mark_dirty(prefixes):
+    """Force the figures whose paths start with any of `prefixes` to be re-rendered."""
+    manifest = load_manifest()
+    for path in list(manifest):
+        if path.startswith(tuple(prefixes)):
+            del manifest[path]
+    save_manifest(manifest)
+
+
+def _use_agg():
+    import matplotlib
+
+    matplotlib.use("Agg", force=True)
+
+
+def _render(job):
+    import matplotlib
+
+    with matplotlib.rc_context(job.get("style")):
+        job["func"](*job["args"], **job["kwargs"])
+    return job["path"]
+
+
+def render_jobs(jobs, n_workers=None, force=False):
+    """Render each figure spec in `jobs` whose output is missing or whose inputs changed
+    since it was last rendered, using `n_workers` processes (or the calling process if
+    `n_workers` is 1). Return the paths that were rendered.
+
+    A figure that fails to render doesn't stop the others: the figures that did render are
+    recorded in the manifest before the first failure is raised.
+    """
+    manifest = load_manifest()
+    hashes = {job["path"]: job_hash(job) for job in jobs}
+    stale = [
+        job
+        for job in jobs
+        if force
+        or not os.path.exists(job["path"])
+        or manifest.get(job["path"]) != hashes[job["path"]]
+    ]
+
+    rendered = []
+    errors = []
+    if n_workers == 1 or len(stale) <= 1:
+        for job in stale:
+            try:
+                rendered.append(_render(job))
+            except Exception as error:
+                errors.append(error)
+    else:
+        with ProcessPoolExecutor(n_workers, initializer=_use_agg) as pool:
+            futures = [pool.submit(_render, job) for job in stale]
+            for future in futures:
+                try:
+                    rendered.append(future.result())
+                except Exception as error:
+                    errors.append(error)
+
+    for path in rendered:
+        manifest[path] = hashes[path]
+    save_manifest(manifest)
+    if errors:
+        raise errors[0]
+    return rendered
+
+
+def get_density(x, y, bins=64, extent=None):
+    """Return a `bins` x `bins` histogram of the points (`x`, `y`), as an image with empty
+    bins masked, together with its extent [x_min, x_max, y_min, y_max]."""
+    if extent is None:
+        extent = [min(x), max(x), min(y), max(y)]
+    counts, _, _ = np.histogram2d(x, y, bins=bins, range=[extent[:2], extent[2:]])
+    return np.ma.masked_equal(counts.T, 0), extent
+
+
+def plot_density(ax, density, **kwargs):
+    """Draw a density from `get_density` on `ax` as a single raster image."""
+    image, extent = density
+    return ax.imshow(
+        image,
+        extent=extent,
+        origin="lower",
+        aspect="auto",
+        interpolation="nearest",
+        **kwargs,
+    )
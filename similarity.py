@@ -0,0 +1,117 @@
+import time
+
+import numpy as np
+
+from sklearn.decomposition import PCA
+from sklearn.neighbors import KDTree
+
+from loader import (
+    cols_quantitative,
+    get_df_pdga_quantitative,
+    get_registry_scaler,
+    get_scaler,
+    scale_array,
+)
+
+
+def build_index(df=None, n_components=None, leaf_size=40):
+    """Return a nearest-neighbor index over the normalized measurements of the discs in
+    `df` (all registered discs by default), reduced to `n_components` principal components
+    if given.
+
+    The measurements of all registered discs are scaled by the registry scaler, as in
+    dim_reduce, and those of any other `df` by a scaler fit to it (see `loader.get_scaler`).
+    """
+    if df is None:
+        df = get_df_pdga_quantitative()
+        scaler = get_registry_scaler()
+    else:
+        scaler = get_scaler(df)
+
+    index = {
+        "keys": df.index,
+        "measurements": df[list(cols_quantitative)],
+        "scaler": scaler,
+        "pca": None,
+    }
+    points = _to_index_space(index, index["measurements"], pca=False)
+    if n_components is not None:
+        index["pca"] = PCA(n_components=n_components).fit(points)
+        points = index["pca"].transform(points)
+
+    index["tree"] = KDTree(points, leaf_size=leaf_size)
+    return index
+
+
+def _to_index_space(index, measurements, pca=True):
+    X = measurements[index["scaler"]["cols"]].to_numpy(dtype="float64", copy=True)
+    points = scale_array(index["scaler"], X, out=X)
+    if pca and index["pca"] is not None:
+        points = index["pca"].transform(points)
+    return points
+
+
+def query_index(index, measurements, k=5):
+    """Return the `k` registered discs most similar to each row of the pd.DataFrame
+    `measurements`, as a pd.DataFrame with one row per (query, rank)."""
+    distances, neighbors = index["tree"].query(
+        _to_index_space(index, measurements), k=k
+    )
+    keys = index["keys"][neighbors.ravel()]
+    result = keys.to_frame(index=False)
+    result.insert(0, "query", np.repeat(measurements.index.to_numpy(), k))
+    result.insert(1, "rank", np.tile(np.arange(1, k + 1), len(measurements)))
+    result["distance"] = distances.ravel()
+    return result
+
+
+def find_similar(index, model, manufacturer=None, k=5):
+    """Return the `k` registered discs most similar to the disc `model` (made by
+    `manufacturer`, if given), excluding the disc itself."""
+    keys = index["keys"]
+    matches = keys.get_level_values("model") == model
+    if manufacturer is not None:
+        matches &= keys.get_level_values("manufacturer") == manufacturer
+    if not matches.any():
+        raise ValueError(f"No registered disc named {model!r}!")
+
+    # A disc may be registered more than once, so each of its registrations can be among
+    # the neighbors of the others, and the queries are told apart by position.
+    measurements = index["measurements"][matches]
+    n_neighbors = k + len(measurements)
+    result = query_index(index, measurements, k=n_neighbors)
+    position = np.repeat(np.arange(len(measurements)), n_neighbors)
+    own = result.set_index(["manufacturer", "model"]).index.isin(measurements.index)
+    result = result[~own]
+    result["rank"] = result.groupby(position[~own]).cumcount() + 1
+    return result[result["rank"] <= k].reset_index(drop=True)
+
+
+def benchmark_index(n_components=None, num_queries=1000, k=5, repeat=5):
+    """Return the best-of-`repeat` seconds taken to build the index, to answer a single
+    query and to answer a batch of `num_queries` queries."""
+    df = get_df_pdga_quantitative()
+    rng = np.random.default_rng(0)
+    queries = df.iloc[rng.integers(len(df), size=num_queries)].reset_index(drop=True)
+
+    def best_time(func):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    index = build_index(df, n_components=n_components)
+    return {
+        "build": best_time(lambda: build_index(df, n_components=n_components)),
+        "single": best_time(lambda: query_index(index, queries.iloc[:1], k=k)),
+        "batch": best_time(lambda: query_index(index, queries, k=k)),
+    }
+
+
+if __name__ == "__main__":
+    index = build_index()
+    print(find_similar(index, "Destroyer", manufacturer="Innova Champion Discs"))
+    print(benchmark_index())
@@ -0,0 +1,145 @@
+import os
+import pickle
+
+import pandas as pd
+
+from correlations import get_correlation_stats, update_correlation_stats
+from loader import (
+    cols_qualitative,
+    cols_quantitative,
+    flight_numbers,
+    flight_tables,
+    get_scaler,
+    iter_pdga_chunks,
+    join_flight_numbers,
+    save_registry_scaler,
+    source_key,
+    update_scaler,
+)
+from predict import predictor_path
+from regression import get_gram_stats, update_gram_stats
+from render import mark_dirty
+
+state_path = os.path.join(".cache", "registry_state.pkl")
+
+# Certification numbers are reused across discs, so a disc is identified by all three.
+cols_key = ["cert_number", "manufacturer", "model"]
+
+
+def _get_keys(chunk):
+    return set(chunk[cols_key].itertuples(index=False, name=None))
+
+
+def _get_innova_rows(chunk):
+    """Return the Innova discs of `chunk` joined with their flight numbers, as by
+    `loader.get_df_innova`."""
+    manufacturer = "Innova Champion Discs"
+    df, _ = join_flight_numbers(
+        {manufacturer: flight_tables[manufacturer]},
+        discs=chunk[cols_qualitative + list(cols_quantitative)],
+    )
+    return df
+
+
+def build_state(path="pdga.csv", degrees=(1, 2), chunksize=10000):
+    """Return the registry statistics kept up to date by `update_registry`: the keys of the
+    ingested discs, the registry scaler (see `loader.get_scaler`), the running statistics of
+    the correlations and, for each of `degrees`, the sums behind the regression Gram
+    matrices."""
+    state = {
+        "keys": set(),
+        "scaler": get_scaler(),
+        "correlation": get_correlation_stats(cols_quantitative),
+        "innova": source_key("innova.csv"),
+    }
+
+    innova_rows = []
+    for chunk in iter_pdga_chunks(path, chunksize=chunksize, include_cert_number=True):
+        _ingest(state, chunk)
+        innova_rows.append(_get_innova_rows(chunk))
+
+    df_innova = pd.concat(innova_rows)
+    state["gram"] = {
+        degree: get_gram_stats(
+            df_innova, cols_quantitative, flight_numbers, degree=degree
+        )
+        for degree in degrees
+    }
+    return state
+
+
+def _ingest(state, chunk):
+    """Add the discs of `chunk` to the keys, scaler and correlation statistics of `state`."""
+    update_scaler(state["scaler"], chunk)
+    update_correlation_stats(state["correlation"], chunk)
+    state["keys"] |= _get_keys(chunk)
+
+
+def load_state(path=state_path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def save_state(state, path=state_path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def update_registry(path="pdga.csv", chunksize=10000):
+    """Ingest the discs of the registry at `path` that weren't seen by the last update,
+    updating the saved statistics in place and marking the figures and models that depend
+    on them as dirty. Return the number of new discs and new Innova discs and the dirty
+    figure directories.
+
+    The statistics are rebuilt from scratch the first time and whenever innova.csv changes.
+    The scaler of pdga.csv is saved for `loader.get_registry_scaler` as well.
+    """
+    state = load_state()
+    if (
+        state is None
+        or state["innova"] != source_key("innova.csv")
+        or "scaler" not in state
+    ):
+        state = build_state(path, chunksize=chunksize)
+        num_new = len(state["keys"])
+        num_new_innova = next(iter(state["gram"].values()))["count"]
+    else:
+        num_new = 0
+        num_new_innova = 0
+        for chunk in iter_pdga_chunks(
+            path, chunksize=chunksize, include_cert_number=True
+        ):
+            keys = chunk[cols_key].itertuples(index=False, name=None)
+            chunk = chunk[[key not in state["keys"] for key in keys]]
+            if not len(chunk):
+                continue
+            _ingest(state, chunk)
+            num_new += len(chunk)
+
+            df_innova = _get_innova_rows(chunk)
+            if len(df_innova):
+                for stats in state["gram"].values():
+                    update_gram_stats(stats, df_innova)
+                num_new_innova += len(df_innova)
+
+    dirty = []
+    if num_new:
+        dirty += ["Figures/Correlations", "Figures/Dim-Reduce"]
+    if num_new_innova:
+        dirty += ["Figures/1d", "Figures/2d"]
+        if os.path.exists(predictor_path):
+            os.remove(predictor_path)
+    mark_dirty(dirty)
+    save_state(state)
+    if os.path.abspath(path) == os.path.abspath("pdga.csv"):
+        save_registry_scaler(state["scaler"])
+
+    return {"new_discs": num_new, "new_innova_discs": num_new_innova, "dirty": dirty}
+
+
+if __name__ == "__main__":
+    print(update_registry())